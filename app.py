@@ -1,21 +1,38 @@
 import os
+import stat
 import subprocess
 import json
 import shutil
 import threading
 import zipfile
-import sys
 import uuid
 import datetime
 import re
+import time
+import bisect
+import hashlib
+import itertools
+import tempfile
+import glob
+import sqlite3
+import asyncio
+import random
+import fcntl
 import requests
-from openai import OpenAI
+from requests.adapters import HTTPAdapter
+from openai import AsyncOpenAI, RateLimitError, APITimeoutError
 from functools import wraps
+from contextlib import contextmanager
+from collections import OrderedDict, deque, Counter
 # Added quote for encoding paths
 from urllib.parse import unquote, unquote_plus, quote
-from flask import Flask, render_template, request, send_file, flash, redirect, url_for, session, jsonify
+from flask import Flask, render_template, request, send_file, flash, redirect, url_for, session, jsonify, Response, stream_with_context
 # New: For multi-threaded concurrent processing
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import ThreadPoolExecutor
+try:
+    from inotify_simple import INotify, flags as inotify_flags
+except ImportError: # Optional: without it the media index falls back to mtime diffing
+    INotify = None
 
 app = Flask(__name__)
 
@@ -24,13 +41,426 @@ ADMIN_USERNAME = os.environ.get('ADMIN_USER', 'admin')
 ADMIN_PASSWORD = os.environ.get('ADMIN_PASS', 'password123') 
 SECRET_KEY = os.environ.get('SECRET_KEY', 'seaside_secret_key')
 DEEPSEEK_API_KEY = os.environ.get('DEEPSEEK_API_KEY', '') 
-DEEPSEEK_BASE_URL = "https://api.deepseek.com"
+DEEPSEEK_BASE_URL = os.environ.get('DEEPSEEK_BASE_URL', "https://api.deepseek.com") # Point at a mock server for testing
 
-BASE_DIR = "/data"
+BASE_DIR = os.environ.get("BASE_DIR", "/data") # Overridable for benchmarks and tests
 CONFIG_FILE = os.path.join(BASE_DIR, '.tracker_config.json')
+PIECE_CACHE_DIR = os.path.join(BASE_DIR, '.piece_cache')
+PIECE_CACHE_MAX_BYTES = int(os.environ.get('PIECE_CACHE_MAX_MB', 256)) * 1024 * 1024
+PROBE_CACHE_DIR = os.path.join(BASE_DIR, '.probe_cache')
+PROBE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+PROBE_CACHE_MEMORY_ITEMS = 256
+TRANSLATION_MEMORY_DB = os.path.join(BASE_DIR, '.translation_memory.db')
+JOBS_DB = os.path.join(BASE_DIR, '.jobs.db')
+MEDIA_INDEX_DB = os.path.join(BASE_DIR, '.media_index.db')
+TASKS_DB = os.path.join(BASE_DIR, '.tasks.db') # Task states shared by all worker processes
+LEADER_LOCK = os.path.join(BASE_DIR, '.leader.lock')
+
+# Torrent hashing: worker threads (hashlib releases the GIL) and pieces per work unit
+HASH_WORKERS = int(os.environ.get('HASH_WORKERS', min(4, os.cpu_count() or 1)))
+HASH_JOB_BYTES = 64 * 1024 * 1024
+HASH_READ_SIZE = int(os.environ.get('HASH_READ_KB', 0)) * 1024 # 0 = read a whole piece per call
+# "auto" piece size: smallest piece in [32 KiB, 64 MiB] that keeps the torrent at or under this many pieces.
+# 64 MiB is the largest size current clients (libtorrent 1.2+/2.x, qBittorrent, Transmission 4) accept,
+# so payloads over ~125 GiB go past the band; a hashing thread holds one piece in memory
+AUTO_PIECE_MAX_PIECES = 2000
+AUTO_PIECE_MIN_EXP, AUTO_PIECE_MAX_EXP = 15, 26
+# Screenshot capture: per-task worker pool size, and the same number as a global cap on running ffmpeg processes
+FFMPEG_WORKERS = int(os.environ.get('FFMPEG_WORKERS', os.cpu_count() or 2))
+# Screenshot seeking: 'accurate' decodes up to the exact timestamp, 'keyframe' grabs the keyframe at or before it
+SHOT_SEEK = os.environ.get('SHOT_SEEK', 'accurate')
+SHOT_DECODE_THREADS = int(os.environ.get('SHOT_DECODE_THREADS', 2)) # Decoder threads per captured frame
+# Blank-frame rejection, on the scaled frame's 8-bit luma: flat (any colour) or near-black frames are re-captured
+# at timestamps nudged by SHOT_NUDGE of the duration, alternately later and earlier, for up to SHOT_RETRY_ROUNDS
+SHOT_FLAT_STDEV = 3.0
+SHOT_DARK_MEAN, SHOT_DARK_STDEV = 24, 10.0
+SHOT_NUDGE = 0.02
+SHOT_RETRY_ROUNDS = 2
+# Screenshot sampling: 'even' spaces shots over the runtime, 'scene' picks them from one keyframe analysis pass
+SHOT_SAMPLING = os.environ.get('SHOT_SAMPLING', 'even')
+SCENE_ANALYSIS_WIDTH = 160 # Keyframes are scaled to this before scene / luma stats
+SCENE_WINDOW = (0.04, 0.92) # Part of the runtime shots may come from (skips cold opens / logos and end credits)
+SCENE_MIN_YAVG, SCENE_MIN_CONTRAST = 30, 40 # Darker or flatter keyframes are never picked
+# Pixhost uploads: endpoint (overridable for a local stand-in server), concurrent uploads per task, attempts per image
+PIXHOST_UPLOAD_URL = os.environ.get('PIXHOST_UPLOAD_URL', "https://api.pixhost.to/images")
+PIXHOST_WORKERS = int(os.environ.get('PIXHOST_WORKERS', 3))
+PIXHOST_RETRIES = 3
+# Job scheduler: concurrent jobs per resource class, and which class/priority each job kind uses
+RESOURCE_LIMITS = {
+    'io': int(os.environ.get('JOBS_IO', 2)),   # Torrent hashing and other disk-bound work
+    'cpu': int(os.environ.get('JOBS_CPU', max(1, (os.cpu_count() or 2) // 2))), # ffmpeg-heavy work
+    'net': int(os.environ.get('JOBS_NET', 4)), # Translation API / uploads
+}
+JOB_KINDS = {'seed': ('io', 10), 'batch': ('io', 8), 'extract': ('io', 6), 'translate': ('net', 5)}
+# Per-job secrets (a DeepSeek key typed into the page) never go into .jobs.db, which sits on the data
+# volume /download serves: each job's are kept in a 0600 file in a private directory outside BASE_DIR
+JOB_SECRET_FIELDS = ('api_key',)
+JOB_SECRETS_DIR = os.environ.get('JOB_SECRETS_DIR', os.path.join(tempfile.gettempdir(), 'torrentmaker-job-secrets'))
+JOB_SCRUB = "payload = json_remove(payload, '$.api_key')" # Clears keys that older versions stored in finished rows
+SEED_STAGE_RESOURCES = {'hash': 'io', 'media': 'cpu', 'upload': 'net'} # Seed/batch jobs take a slot per stage
+# Batch seeding: hashing runs one item at a time; these size the screenshot and upload stage pools
+BATCH_MEDIA_WORKERS = int(os.environ.get('BATCH_MEDIA_WORKERS', 2))
+BATCH_UPLOAD_WORKERS = 2
+BATCH_MAX_ITEMS = 200
+# Task registry: finished tasks are dropped after TASK_TTL seconds or once TASK_STORE_MAX tasks are held
+TASK_STORE_MAX = int(os.environ.get('TASK_STORE_MAX', 200))
+TASK_TTL = int(os.environ.get('TASK_TTL', 24 * 3600))
+TASK_LOG_LINES = 500 # Log ring buffer per task
+# Multi-process serving: how often the leader publishes task states (and picks up jobs / cancels queued
+# by other workers), and how often a follower retries for the leader lock
+TASK_SYNC_INTERVAL = 0.5
+TASK_ACCESS_FLUSH = 5 # Seconds a worker batches task views before writing their access times (LRU order)
+JOB_POLL_INTERVAL = 1
+LEADER_RETRY = 5
+METRICS_PUBLISH_EVERY = 10 # Sync rounds between metric snapshots for followers' /metrics
+# Media index crawler: seconds between passes, full re-stat every N passes, videos probed for duration per pass
+INDEX_INTERVAL = int(os.environ.get('INDEX_INTERVAL', 60))
+INDEX_FULL_EVERY = 10
+INDEX_PROBE_BATCH = 20
+INDEX_INOTIFY_MASK = (inotify_flags.CREATE | inotify_flags.DELETE | inotify_flags.MOVED_FROM | inotify_flags.MOVED_TO
+                      | inotify_flags.CLOSE_WRITE) if INotify else 0
+VIDEO_EXTENSIONS = ('.mkv', '.mp4', '.m2ts', '.ts', '.avi', '.mov', '.wmv', '.webm', '.flv', '.mpg', '.mpeg', '.vob')
+LARGEST_FILE_MIN_BYTES = 50 * 1024 * 1024 # Smaller files are never picked for MediaInfo / screenshots
+SHOTS_ZIP_SUFFIX = "_Screenshots.zip"
+DOWNLOAD_MAX_AGE = 300 # Seconds clients may reuse a download before revalidating with ETag / Last-Modified
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', 500)) # Entries per /api/list_files page
+LIST_CACHE_TTL = 5 # Seconds a directory scan is reused while the directory mtime is unchanged
+LIST_CACHE_DIRS = 64
+TASK_MAX_SPANS = 200 # Structured stage timings kept per task
+# /metrics: histogram buckets (seconds); set METRICS_TOKEN to let a scraper in without a login session
+METRIC_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN', '')
+SSE_KEEPALIVE = 15 # Seconds between comment lines on an idle event stream (keeps proxies from closing it)
+# Parent of the per-task scratch directories; point at a tmpfs such as /dev/shm to keep frames in RAM
+SCRATCH_DIR = os.environ.get('SCRATCH_DIR', tempfile.gettempdir())
+TORRENT_CREATED_BY = "mktorrent 1.1"
 
 app.secret_key = SECRET_KEY
-task_store = {} # Store the status and logs for all tasks (seeding + translation)
+app.config['JSON_AS_ASCII'] = False
+ffmpeg_slots = threading.BoundedSemaphore(FFMPEG_WORKERS) # Shared by every running task
+# Keep-alive connection pool for outbound HTTP (Pixhost uploads)
+http_session = requests.Session()
+http_session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=max(10, PIXHOST_WORKERS * 2)))
+http_session.mount('http://', HTTPAdapter(pool_connections=4, pool_maxsize=max(10, PIXHOST_WORKERS * 2)))
+
+class TaskStore(OrderedDict):
+    """
+    Status and logs for all tasks (seeding + translation). Finished tasks expire after `ttl`
+    seconds, or least-recently-used first once more than `max_tasks` are held; queued and
+    running tasks are never evicted.
+
+    The dict holds the live states of tasks running in this process. The leader process
+    publishes them to SQLite (`publish`), so every worker can serve them via `view`.
+    Writes share one connection under `db_lock`; reads use a connection per thread, and
+    view times are batched in memory and written with the next write or every few seconds.
+    """
+    def __init__(self, max_tasks, ttl, db_path=None, log_lines=TASK_LOG_LINES):
+        super().__init__()
+        self.max_tasks, self.ttl, self.log_lines = max_tasks, ttl, log_lines
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock) # Wakes event streams on new logs / tasks / published changes
+        self.generation = 0 # Bumped on every notify, so a waiter can't miss one that landed before it waited
+        self.db_path, self.conn = db_path, None
+        self.db_lock = threading.Lock()
+        self.readers = threading.local() # Per-thread read connection (WAL: reads never wait on the writer)
+        self.published = {} # task_id -> (state JSON, log_seq) last written by publish()
+        self.accessed, self.access_flushed = {}, time.time() # task_id -> last view time, not yet in the table
+
+    def __setitem__(self, task_id, state):
+        with self.lock:
+            super().__setitem__(task_id, state)
+            self.move_to_end(task_id)
+            self.sweep()
+            self.notify()
+
+    def notify(self):
+        with self.changed:
+            self.generation += 1
+            self.changed.notify_all()
+
+    def touch(self, task_id):
+        with self.lock:
+            if task_id in self: self.move_to_end(task_id)
+
+    def sweep(self):
+        with self.lock:
+            now = time.time()
+            finished = []
+            for task_id, state in list(self.items()):
+                if state.get('status') not in ('done', 'error'): continue
+                state.setdefault('finished_at', now) # First time the sweep sees it finished
+                if now - state['finished_at'] > self.ttl: del self[task_id]
+                else: finished.append(task_id)
+            for task_id in finished[:max(0, len(self) - self.max_tasks)]: del self[task_id]
+
+    def _db(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self.conn.execute("PRAGMA journal_mode=WAL") # Readers in other workers never block the publisher
+            self.conn.executescript("""
+                CREATE TABLE IF NOT EXISTS tasks (id TEXT PRIMARY KEY, status TEXT, state TEXT NOT NULL,
+                    log_seq INTEGER NOT NULL, finished REAL, accessed REAL);
+                CREATE TABLE IF NOT EXISTS task_logs (task_id TEXT, seq INTEGER, line TEXT, PRIMARY KEY (task_id, seq)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS shared (key TEXT PRIMARY KEY, value TEXT, updated REAL);""")
+            try: self.conn.execute("ALTER TABLE tasks ADD COLUMN version INTEGER NOT NULL DEFAULT 0") # Bumped on every write
+            except sqlite3.OperationalError: pass # Already there
+        return self.conn
+
+    def _reader(self):
+        conn = getattr(self.readers, 'conn', None)
+        if conn is None:
+            with self.db_lock: self._db() # Schema first
+            conn = self.readers.conn = sqlite3.connect(self.db_path, timeout=30)
+        return conn
+
+    def _flush_access(self, db):
+        """Write the batched view times; the caller holds db_lock and commits"""
+        with self.lock: accessed, self.accessed, self.access_flushed = self.accessed, {}, time.time()
+        db.executemany("UPDATE tasks SET accessed = MAX(COALESCE(accessed, 0), ?) WHERE id = ?", [(t, task_id) for task_id, t in accessed.items()])
+
+    def _write(self, db, task_id, view, lines=()):
+        # Finished rows written by put/patch (e.g. a cancelled queued job) never pass through sweep()
+        if view.get('status') in ('done', 'error'): view.setdefault('finished_at', time.time())
+        first = view['log_seq'] - len(lines) + 1
+        db.executemany("INSERT OR REPLACE INTO task_logs VALUES (?, ?, ?)", [(task_id, first + i, line) for i, line in enumerate(lines)])
+        db.execute("DELETE FROM task_logs WHERE task_id = ? AND seq <= ?", (task_id, view['log_seq'] - self.log_lines))
+        db.execute("""INSERT INTO tasks (id, status, state, log_seq, finished, accessed) VALUES (?, ?, ?, ?, ?, ?)
+                      ON CONFLICT(id) DO UPDATE SET status = excluded.status, state = excluded.state,
+                      log_seq = excluded.log_seq, finished = excluded.finished, version = tasks.version + 1""",
+                   (task_id, view.get('status'), json.dumps(view, ensure_ascii=False), view['log_seq'], view.get('finished_at'), time.time()))
+
+    def put(self, task_id, state):
+        """Write a state straight to the shared table (new/queued tasks, which no process runs yet)"""
+        with self.db_lock:
+            db = self._db()
+            db.execute("DELETE FROM task_logs WHERE task_id = ?", (task_id,))
+            self._write(db, task_id, dict(state, log_seq=0))
+            db.commit()
+        self.notify()
+
+    def patch(self, task_id, **fields):
+        """Update a task wherever it lives: the local state if this process runs it, else the shared row"""
+        with self.lock:
+            if task_id in self:
+                self[task_id].update(fields)
+                return
+        with self.db_lock:
+            db = self._db()
+            row = db.execute("SELECT state FROM tasks WHERE id = ?", (task_id,)).fetchone()
+            if row is None: return
+            self._write(db, task_id, dict(json.loads(row[0]), **fields))
+            db.commit()
+
+    def view(self, task_id, since=None):
+        """JSON-safe view of a task (see task_view): the live state when it runs here, else the last published one"""
+        with self.lock:
+            state = self.get(task_id)
+            if state is not None:
+                self.move_to_end(task_id)
+                return task_view(state, since)
+        if not self.db_path: return None
+        db = self._reader()
+        with db: # One read transaction, so the state and its log lines match
+            db.execute("BEGIN")
+            row = db.execute("SELECT state, log_seq FROM tasks WHERE id = ?", (task_id,)).fetchone()
+            if row is None: return None
+            lines = db.execute("SELECT seq, line FROM task_logs WHERE task_id = ? AND seq > ? ORDER BY seq", (task_id, since or 0)).fetchall()
+        with self.lock:
+            self.accessed[task_id] = time.time()
+            due = time.time() - self.access_flushed >= TASK_ACCESS_FLUSH
+        if due:
+            with self.db_lock:
+                self._flush_access(self._db())
+                self.conn.commit()
+        view = json.loads(row[0])
+        view.update(logs=[line for _, line in lines], log_seq=row[1],
+                    logs_truncated=bool(lines) and lines[0][0] > (since or 0) + 1)
+        return view
+
+    def _version(self, task_id):
+        row = self._reader().execute("SELECT version FROM tasks WHERE id = ?", (task_id,)).fetchone()
+        return row[0] if row else None
+
+    def mark(self, task_id):
+        """Change marker for wait(); take it before the view() it guards, so no change falls in between"""
+        with self.lock:
+            if task_id in self or not self.db_path: return self.generation, None
+        return self.generation, self._version(task_id)
+
+    def wait(self, task_id, mark, timeout):
+        """
+        Block until something changed after `mark` or `timeout` passed: woken by notify() when the
+        task runs here; when another worker runs it, by polling its row's version (a key lookup,
+        so the caller's full view() only runs once there is something new)
+        """
+        generation, version = mark
+        with self.changed:
+            if task_id in self or not self.db_path:
+                self.changed.wait_for(lambda: self.generation != generation, timeout=timeout)
+                return
+        deadline = time.time() + timeout
+        while True:
+            time.sleep(max(0.0, min(TASK_SYNC_INTERVAL, deadline - time.time())))
+            if time.time() >= deadline or self._version(task_id) != version: return
+
+    def publish(self):
+        """Leader side: write tasks whose state or logs changed since the last call, and expire old rows"""
+        with self.lock:
+            self.sweep()
+            snapshot = [(task_id, task_view(state, self.published.get(task_id, (None, 0))[1])) for task_id, state in self.items()]
+        now = time.time()
+        written = 0
+        with self.db_lock:
+            db = self._db()
+            for task_id, view in snapshot:
+                lines = view.pop('logs'); view.pop('logs_truncated')
+                body = json.dumps(view, ensure_ascii=False, sort_keys=True)
+                if not lines and self.published.get(task_id, (None,))[0] == body: continue
+                self._write(db, task_id, view, lines)
+                self.published[task_id] = (body, view['log_seq'])
+                written += 1
+            self._flush_access(db)
+            # Same policy as sweep(): TTL first, then least recently viewed beyond max_tasks
+            db.execute("DELETE FROM tasks WHERE finished IS NOT NULL AND finished < ?", (now - self.ttl,))
+            db.execute("""DELETE FROM tasks WHERE id IN (SELECT id FROM tasks WHERE finished IS NOT NULL
+                          ORDER BY accessed DESC LIMIT -1 OFFSET ?)""", (self.max_tasks,))
+            db.execute("DELETE FROM task_logs WHERE task_id NOT IN (SELECT id FROM tasks)")
+            db.commit()
+        if written: self.notify() # Field changes (msg, progress, files...) reach this process's event streams too
+        for task_id in set(self.published) - {task_id for task_id, _ in snapshot}: self.published.pop(task_id, None)
+
+    def statuses(self):
+        """Status of every known task, local or published"""
+        with self.lock: local = {task_id: state.get('status', 'unknown') for task_id, state in self.items()}
+        if not self.db_path: return local
+        rows = self._reader().execute("SELECT id, status FROM tasks").fetchall()
+        return dict({task_id: status or 'unknown' for task_id, status in rows}, **local)
+
+    def put_shared(self, key, value):
+        with self.db_lock:
+            db = self._db()
+            db.execute("INSERT OR REPLACE INTO shared VALUES (?, ?, ?)", (key, value, time.time()))
+            db.commit()
+
+    def get_shared(self, key):
+        row = self._reader().execute("SELECT value FROM shared WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+def task_view(state, since=None):
+    """JSON-safe copy of a task state; with `since`, only log lines after that sequence number"""
+    view = {k: v for k, v in state.items() if k != 'logs'}
+    logs = state.get('logs') or ()
+    since = since or 0
+    view['logs'] = [entry['line'] for entry in logs if entry['seq'] > since]
+    view['log_seq'] = state.get('log_seq', 0)
+    # Lines between the cursor and the oldest buffered line fell out of the ring buffer
+    view['logs_truncated'] = bool(logs) and logs[0]['seq'] > since + 1
+    return view
+
+task_store = TaskStore(TASK_STORE_MAX, TASK_TTL, TASKS_DB)
+
+# ================= Metrics =================
+class Metrics:
+    """
+    Minimal in-process metrics registry (counters, histograms, scrape-time gauges) with
+    labels, rendered in the Prometheus text exposition format by /metrics.
+    """
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.lock = threading.Lock()
+        self.counters = {}   # (name, labels) -> value
+        self.histograms = {} # (name, labels) -> [per-bucket counts..., +Inf count], sum
+        self.gauges = {}     # name -> callable returning [(labels dict, value)]
+        self.help = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def describe(self, name, kind, text):
+        self.help[name] = (kind, text)
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self.lock: self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self.lock:
+            counts, total = self.histograms.get(key) or ([0] * (len(self.buckets) + 1), 0.0)
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            self.histograms[key] = (counts, total + value)
+
+    def gauge(self, name, fn):
+        self.gauges[name] = fn
+
+    @staticmethod
+    def _labels(pairs):
+        if not pairs: return ""
+        escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+        return "{" + ",".join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + "}"
+
+    def render(self):
+        lines = []
+        def header(name, default_kind):
+            kind, text = self.help.get(name, (default_kind, name))
+            lines.extend([f"# HELP {name} {text}", f"# TYPE {name} {kind}"])
+        with self.lock:
+            counters = sorted(self.counters.items()); histograms = sorted(self.histograms.items())
+        for name, group in itertools.groupby(counters, key=lambda kv: kv[0][0]):
+            header(name, 'counter')
+            lines.extend(f"{name}{self._labels(labels)} {value}" for (_, labels), value in group)
+        for name, group in itertools.groupby(histograms, key=lambda kv: kv[0][0]):
+            header(name, 'histogram')
+            for (_, labels), (counts, total) in group:
+                cumulative = 0
+                for bound, count in zip(list(self.buckets) + ['+Inf'], counts):
+                    cumulative += count
+                    lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+                lines.append(f"{name}_sum{self._labels(labels)} {round(total, 6)}")
+                lines.append(f"{name}_count{self._labels(labels)} {cumulative}")
+        for name, fn in sorted(self.gauges.items()):
+            try: samples = fn()
+            except Exception: continue # A broken gauge must not break the scrape
+            header(name, 'gauge')
+            lines.extend(f"{name}{self._labels(tuple(sorted(labels.items())))} {value}" for labels, value in samples)
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics(METRIC_BUCKETS)
+metrics.describe('torrentmaker_stage_seconds', 'histogram', 'Wall time of pipeline stages')
+metrics.describe('torrentmaker_subprocess_launches_total', 'counter', 'External processes started, by program')
+metrics.describe('torrentmaker_subprocess_seconds', 'histogram', 'Run time of external processes, by program')
+metrics.describe('torrentmaker_hashed_bytes_total', 'counter', 'Payload bytes SHA-1 hashed for torrents')
+metrics.describe('torrentmaker_piece_cache_total', 'counter', 'Piece-hash cache lookups by result')
+metrics.describe('torrentmaker_retries_total', 'counter', 'Retried outbound requests, by component')
+metrics.describe('torrentmaker_translate_request_seconds', 'histogram', 'Translation API request latency by outcome')
+metrics.describe('torrentmaker_queue_jobs', 'gauge', 'Scheduler jobs by resource class and state')
+metrics.describe('torrentmaker_tasks', 'gauge', 'Tasks held in the task store by status')
+
+@contextmanager
+def stage_span(stage, task_id=None, **labels):
+    """Time a pipeline stage into the stage histogram and, with a task_id, the task's structured span list"""
+    started = time.time(); outcome = 'ok'
+    try: yield
+    except BaseException:
+        outcome = 'error'; raise
+    finally:
+        elapsed = time.time() - started
+        metrics.observe('torrentmaker_stage_seconds', elapsed, stage=stage, outcome=outcome, **labels)
+        state = task_store.get(task_id) if task_id else None
+        if state is not None:
+            spans = state.setdefault('spans', [])
+            spans.append({'stage': stage, 'start': round(started, 3), 'seconds': round(elapsed, 3), 'outcome': outcome, **labels})
+            if len(spans) > TASK_MAX_SPANS: del spans[:len(spans) - TASK_MAX_SPANS]
+
+def run_cmd(cmd, **kwargs):
+    """subprocess.run, counted and timed per program for /metrics"""
+    program = os.path.basename(cmd[0])
+    metrics.inc('torrentmaker_subprocess_launches_total', program=program)
+    started = time.time()
+    try: return subprocess.run(cmd, **kwargs)
+    finally: metrics.observe('torrentmaker_subprocess_seconds', time.time() - started, program=program)
+
 
 # ================= Auxiliary functions =================
 
@@ -40,12 +470,15 @@ def log_task(task_id, message):
     log_entry = f"[{timestamp}] {message}"
     print(log_entry, flush=True) # Console output
     
-    if task_id in task_store:
-        # Stored in memory for front-end polling
-        if 'logs' not in task_store[task_id]:
-            task_store[task_id]['logs'] = []
-        task_store[task_id]['logs'].append(log_entry)
-        task_store[task_id]['msg'] = message # Update brief status
+    with task_store.lock:
+        state = task_store.get(task_id)
+        if state is None: return
+        # Fixed-size ring buffer; log_seq keeps counting so pollers can ask for lines after a cursor
+        if not isinstance(state.get('logs'), deque): state['logs'] = deque(maxlen=TASK_LOG_LINES)
+        state['log_seq'] = state.get('log_seq', 0) + 1
+        state['logs'].append({'seq': state['log_seq'], 'time': timestamp, 'line': log_entry})
+        state['msg'] = message # Update brief status
+        task_store.notify()
 
 def get_safe_path(rel_path):
     if not rel_path: rel_path = ""
@@ -55,6 +488,15 @@ def get_safe_path(rel_path):
     if not abs_target.startswith(abs_base): raise ValueError("Unauthorised path access")
     return abs_target
 
+def backoff_delay(attempt, base=1.0, cap=30.0):
+    """Exponential backoff with full jitter: uniform in [0, min(cap, base * 2^attempt)]"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+def make_task_workspace(task_id):
+    """Private scratch directory for one task; the caller removes it when the task finishes"""
+    os.makedirs(SCRATCH_DIR, exist_ok=True)
+    return tempfile.mkdtemp(prefix=f"task_{task_id}_", dir=SCRATCH_DIR)
+
 def load_default_tracker():
     default_url = "http://udp.opentrackr.org:1337/announce"
     try:
@@ -70,8 +512,65 @@ def save_default_tracker(url):
         with open(CONFIG_FILE, 'w') as f: json.dump({'tracker_url': url}, f)
     except Exception: pass
 
+class DiskCache:
+    """
+    Small file-per-entry cache with an LRU size cap. Entry mtimes double as the
+    LRU clock: hits touch the file, eviction removes the oldest until under the cap.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode('utf-8')).hexdigest())
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f: data = f.read()
+            os.utime(path)
+            return data
+        except OSError: return None
+
+    def put(self, key, data):
+        with self.lock:
+            try:
+                os.makedirs(self.directory, exist_ok=True)
+                path = self._path(key)
+                with open(path + ".tmp", 'wb') as f: f.write(data)
+                os.replace(path + ".tmp", path)
+                self._evict()
+            except OSError: pass
+
+    def delete(self, key):
+        try: os.remove(self._path(key))
+        except OSError: pass
+
+    def _evict(self):
+        entries = []
+        for entry in os.scandir(self.directory):
+            try: st = entry.stat()
+            except OSError: continue
+            entries.append((st.st_mtime, st.st_size, entry.path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes: break
+            try: os.remove(path); total -= size
+            except OSError: pass
+
+piece_cache = DiskCache(PIECE_CACHE_DIR, PIECE_CACHE_MAX_BYTES)
+
 def find_largest_file(start_path):
     if os.path.isfile(start_path): return start_path
+    # Answer from the media index when it has crawled every folder of the subtree since it last changed
+    summary = media_index.dir_summary(start_path)
+    if summary and media_index.subtree_current(start_path):
+        if not summary['largest_media'] or summary['largest_size'] <= LARGEST_FILE_MIN_BYTES: return None
+        candidate = os.path.join(media_index.root, summary['largest_media'])
+        try:
+            if os.path.getsize(candidate) == summary['largest_size']: return candidate
+        except OSError: pass
     largest_file = None; max_size = 0
     for root, dirs, files in os.walk(start_path):
         for f in files:
@@ -79,198 +578,941 @@ def find_largest_file(start_path):
             if 'torrent' in root.split(os.sep): continue
             try:
                 size = os.path.getsize(file_path)
-                if size > max_size and size > 50 * 1024 * 1024:
+                if size > max_size and size > LARGEST_FILE_MIN_BYTES:
                     max_size = size; largest_file = file_path
             except OSError: continue
     return largest_file
 
+# === Probe cache: one ffprobe / MediaInfo run per file version, shared by every consumer ===
+probe_disk_cache = DiskCache(PROBE_CACHE_DIR, PROBE_CACHE_MAX_BYTES)
+_probe_memory = OrderedDict()
+_probe_lock = threading.Lock()
+
+def _cached_probe(path, kind, produce):
+    """Look up (path, size, mtime, kind) in the in-memory LRU, then on disk; run produce() on a miss. Failures are not cached"""
+    st = os.stat(path)
+    key = f"{os.path.abspath(path)}|{st.st_size}|{st.st_mtime_ns}|{kind}"
+    with _probe_lock:
+        if key in _probe_memory:
+            _probe_memory.move_to_end(key)
+            return _probe_memory[key]
+    raw = probe_disk_cache.get(key)
+    value = json.loads(raw) if raw is not None else produce()
+    if value is None: return None
+    if raw is None: probe_disk_cache.put(key, json.dumps(value).encode('utf-8'))
+    with _probe_lock:
+        _probe_memory[key] = value
+        _probe_memory.move_to_end(key)
+        while len(_probe_memory) > PROBE_CACHE_MEMORY_ITEMS: _probe_memory.popitem(last=False)
+    return value
+
+def probe_media(video_path):
+    """Full ffprobe JSON (format + all streams), or None if the file cannot be probed"""
+    def _run():
+        cmd = ["ffprobe", "-v", "error", "-show_format", "-show_streams", "-of", "json", video_path]
+        result = run_cmd(cmd, capture_output=True, text=True)
+        if result.returncode != 0: return None
+        try: return json.loads(result.stdout)
+        except ValueError: return None
+    try: return _cached_probe(video_path, 'ffprobe', _run)
+    except OSError: return None
+
+def get_mediainfo_text(video_path):
+    """MediaInfo report text, or None if mediainfo failed"""
+    def _run():
+        result = run_cmd(["mediainfo", video_path], capture_output=True)
+        text = result.stdout.decode('utf-8', errors='replace')
+        return text if result.returncode == 0 and text.strip() else None
+    try: return _cached_probe(video_path, 'mediainfo', _run)
+    except OSError: return None
+
+def get_media_streams(video_path, codec_type):
+    """Streams of one type ('video', 'audio', 'subtitle') from the cached probe, or None if unreadable"""
+    data = probe_media(video_path)
+    if data is None: return None
+    return [st for st in data.get('streams', []) if st.get('codec_type') == codec_type]
+
 def get_video_duration(video_path):
     try:
-        cmd = ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", video_path]
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        val = result.stdout.strip()
+        data = probe_media(video_path) or {}
+        val = data.get('format', {}).get('duration')
         return float(val) if val else 0
     except: return 0
 
 # === Translation Logic (Multithreaded Concurrency Optimisation Edition) ===
-def background_translate(task_id, file_path):
+# Batches are sized by estimated prompt tokens rather than cue count
+TRANSLATE_BATCH_TOKENS = int(os.environ.get('TRANSLATE_BATCH_TOKENS', 1500))
+TRANSLATE_MAX_CUES = 80
+# AIMD concurrency window: starts at the initial value, grows on success, halves on 429/timeouts
+TRANSLATE_INITIAL_WORKERS = 4
+TRANSLATE_MAX_WORKERS = int(os.environ.get('TRANSLATE_MAX_WORKERS', 8))
+TRANSLATE_RETRIES = 5
+TRANSLATE_REPAIR_ROUNDS = 2 # Follow-up requests for cues missing or corrupted in a streamed reply
+TRANSLATE_TIMEOUT = 120
+TRANSLATION_SYSTEM_PROMPT = (
+    "You are a multilingual film subtitling expert. I shall send you the original SRT file complete with timecodes."
+    "Please translate the dialogue into fluent, natural Simplified Chinese, taking into account the context."
+    "**Strictly adhere to the following formatting rules**："
+    "1. **The original numbering and timeline must be retained without exception.** Modifying the figures is strictly prohibited."
+    "2. Replace only the foreign-language dialogue beneath the timeline with its Chinese translation."
+    "3. Retain the original SRT format structure (number-time-text), with blank lines separating paragraphs."
+    "4. Do not output any explanatory text; output only the translated SRT content."
+)
+# Bump whenever the prompt or model settings change, so older translation-memory entries stop matching
+TRANSLATION_PROMPT_VERSION = 1
+TRANSLATION_TARGET_LANG = "zh-Hans"
+
+def iter_subtitle_blocks(file_path, is_srt):
+    """
+    Lazily yield (block, bytes_consumed). SRT files yield one cue per blank-line separated
+    block; plain text yields every non-empty line.
+    """
+    current = []
+    consumed = 0
+    with open(file_path, 'rb') as f:
+        for raw in f:
+            consumed += len(raw)
+            text = raw.decode('utf-8', errors='ignore')
+            if consumed == len(raw): text = text.lstrip('\ufeff')
+            # Uniform line break (old Mac files arrive as one raw line full of bare \r)
+            lines = text.replace('\r\n', '\n').replace('\r', '\n').split('\n')
+            if lines[-1] == '': lines.pop()
+            for line in lines:
+                if not is_srt:
+                    if line.strip(): yield line.strip(), consumed
+                elif line.strip():
+                    current.append(line)
+                elif current:
+                    yield "\n".join(current).strip(), consumed
+                    current = []
+    if current: yield "\n".join(current).strip(), consumed
+
+def estimate_tokens(text):
+    """Rough token count: ~4 ASCII characters per token, one token per CJK/other character"""
+    ascii_chars = sum(1 for c in text if ord(c) < 128)
+    return ascii_chars // 4 + (len(text) - ascii_chars) + 1
+
+def iter_translation_batches(file_path, is_srt, token_budget=TRANSLATE_BATCH_TOKENS, max_cues=TRANSLATE_MAX_CUES):
+    """Lazily group blocks into (batch_index, blocks, bytes_consumed) batches within the token budget"""
+    batch = []; tokens = 0; index = 0; consumed = 0
+    for block, block_consumed in iter_subtitle_blocks(file_path, is_srt):
+        cost = estimate_tokens(block)
+        if batch and (tokens + cost > token_budget or len(batch) >= max_cues):
+            yield index, batch, consumed
+            batch = []; tokens = 0; index += 1
+        batch.append(block); tokens += cost; consumed = block_consumed
+    if batch: yield index, batch, consumed
+
+def _load_translation_checkpoint(checkpoint_path, signature, output_path):
+    """Return the saved state if it belongs to this source version and batching, else None"""
+    try:
+        with open(checkpoint_path, 'r') as f: state = json.load(f)
+        if state.get('signature') == signature and os.path.getsize(output_path) >= state['output_bytes']:
+            return state
+    except (OSError, ValueError, KeyError): pass
+    return None
+
+def _save_translation_checkpoint(checkpoint_path, state):
+    with open(checkpoint_path + ".tmp", 'w') as f: json.dump(state, f)
+    os.replace(checkpoint_path + ".tmp", checkpoint_path)
+
+# === Translation memory: cue-level cache so repeated lines never hit the API twice ===
+class TranslationMemory:
+    """SQLite table of translated cue text keyed by normalised source text, target language and prompt version"""
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self.lock = threading.Lock()
+        self.conn = None
+
+    def _connect(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self.conn.execute("CREATE TABLE IF NOT EXISTS tm (key TEXT PRIMARY KEY, translation TEXT NOT NULL, hits INTEGER DEFAULT 0, updated REAL)")
+        return self.conn
+
+    @staticmethod
+    def key(source_text):
+        normalised = re.sub(r'\s+', ' ', source_text).strip()
+        return hashlib.sha1(f"{TRANSLATION_PROMPT_VERSION}|{TRANSLATION_TARGET_LANG}|{normalised}".encode('utf-8')).hexdigest()
+
+    def get_many(self, source_texts):
+        """Return {source_text: translation} for every text already in memory"""
+        keys = {self.key(t): t for t in source_texts}
+        if not keys: return {}
+        try:
+            with self.lock:
+                conn = self._connect()
+                rows = conn.execute(f"SELECT key, translation FROM tm WHERE key IN ({','.join('?' * len(keys))})", list(keys)).fetchall()
+                if rows:
+                    conn.executemany("UPDATE tm SET hits = hits + 1 WHERE key = ?", [(k,) for k, _ in rows])
+                    conn.commit()
+        except sqlite3.Error: return {}
+        return {keys[k]: translation for k, translation in rows}
+
+    def put_many(self, pairs):
+        """Store [(source_text, translation)]"""
+        if not pairs: return
+        try:
+            with self.lock:
+                conn = self._connect()
+                conn.executemany("INSERT OR REPLACE INTO tm (key, translation, updated) VALUES (?, ?, ?)",
+                                 [(self.key(src), dst, time.time()) for src, dst in pairs])
+                conn.commit()
+        except sqlite3.Error: pass
+
+translation_memory = TranslationMemory(TRANSLATION_MEMORY_DB)
+
+def parse_srt_cue(block):
+    """Split one SRT block into (index, timecode, text); None if it is not a well-formed cue"""
+    lines = block.strip().split('\n')
+    if len(lines) < 2 or not lines[0].strip().isdigit() or '-->' not in lines[1]: return None
+    return lines[0].strip(), lines[1].strip(), "\n".join(lines[2:]).strip()
+
+def _cue_sources(batch_blocks, is_srt):
+    """Source text of each block, as used for translation-memory lookups"""
+    if not is_srt: return list(batch_blocks)
+    cues = [parse_srt_cue(b) for b in batch_blocks]
+    return [c[2] if c else b for c, b in zip(cues, batch_blocks)]
+
+def _render_from_memory(batch_blocks, is_srt, cached):
+    """Rebuild a batch from memory when every cue is cached; None otherwise"""
+    sources = _cue_sources(batch_blocks, is_srt)
+    if not all(src in cached for src in sources): return None
+    if not is_srt: return "\n\n".join(cached[src] for src in sources)
+    out = []
+    for block, src in zip(batch_blocks, sources):
+        cue = parse_srt_cue(block)
+        if cue is None: return None
+        out.append(f"{cue[0]}\n{cue[1]}\n{cached[src]}")
+    return "\n\n".join(out)
+
+class AdaptiveLimiter:
+    """AIMD concurrency window: +1 after a window's worth of successes, halved on rate limits or timeouts"""
+    def __init__(self, initial, minimum, maximum):
+        self.limit = float(initial); self.minimum = minimum; self.maximum = maximum
+        self.active = 0; self.successes = 0
+        self.cond = asyncio.Condition()
+
+    async def acquire(self):
+        async with self.cond:
+            while self.active >= int(self.limit): await self.cond.wait()
+            self.active += 1
+
+    async def release(self, outcome):
+        """outcome: 'ok', 'throttled' or 'error'"""
+        async with self.cond:
+            self.active -= 1
+            if outcome == 'ok':
+                self.successes += 1
+                if self.successes >= int(self.limit):
+                    self.limit = min(self.maximum, self.limit + 1); self.successes = 0
+            elif outcome == 'throttled':
+                self.limit = max(self.minimum, self.limit / 2); self.successes = 0
+            self.cond.notify_all()
+
+class TranslationRun:
+    """
+    Per-task state shared by the batch coroutines: client, AIMD limiter, translation-memory
+    counters and request metrics. Create it inside the running event loop.
+    """
+    def __init__(self, task_id, client, is_srt):
+        self.task_id = task_id; self.client = client; self.is_srt = is_srt
+        self.limiter = AdaptiveLimiter(TRANSLATE_INITIAL_WORKERS, 1, TRANSLATE_MAX_WORKERS)
+        self.tm = {'hits': 0, 'misses': 0, 'skipped_calls': 0}
+        self.metrics = {'requests': 0, 'retries': 0, 'throttled': 0, 'failed_batches': 0,
+                        'repair_requests': 0, 'repaired_cues': 0, 'fallback_cues': 0,
+                        'prompt_tokens': 0, 'completion_tokens': 0, 'latency_total': 0.0, 'latency_max': 0.0}
+        self.recent = deque(maxlen=50)
+
+    def record_request(self, batch_index, latency, outcome, usage=None):
+        metrics.observe('torrentmaker_translate_request_seconds', latency, outcome=outcome)
+        m = self.metrics
+        m['requests'] += 1
+        m['latency_total'] += latency; m['latency_max'] = max(m['latency_max'], latency)
+        if outcome == 'throttled': m['throttled'] += 1
+        prompt = getattr(usage, 'prompt_tokens', 0) or 0
+        completion = getattr(usage, 'completion_tokens', 0) or 0
+        m['prompt_tokens'] += prompt; m['completion_tokens'] += completion
+        self.recent.append({'batch': batch_index, 'latency': round(latency, 3), 'outcome': outcome,
+                            'prompt_tokens': prompt, 'completion_tokens': completion})
+
+    def snapshot(self):
+        m = dict(self.metrics)
+        m['latency_avg'] = round(m['latency_total'] / m['requests'], 3) if m['requests'] else 0.0
+        m['concurrency'] = int(self.limiter.limit)
+        m['recent'] = list(self.recent)
+        return {'translation_metrics': m, 'translation_memory': dict(self.tm)}
+
+class SrtStreamParser:
+    """Incremental block splitter for streamed completions: feed() returns the blocks completed so far"""
+    def __init__(self):
+        self.buffer = ""
+
+    def feed(self, text):
+        self.buffer += text.replace('\r\n', '\n')
+        parts = re.split(r'\n[ \t]*\n', self.buffer)
+        self.buffer = parts.pop()
+        return [b for b in (self._clean(p) for p in parts) if b]
+
+    def close(self):
+        block = self._clean(self.buffer); self.buffer = ""
+        return [block] if block else []
+
+    @staticmethod
+    def _clean(block):
+        # Drop markdown fences the model sometimes wraps around the SRT
+        return "\n".join(l for l in block.split('\n') if not l.strip().startswith('```')).strip()
+
+def _retry_after(exc):
+    """Seconds from a Retry-After header on an API error, if the server sent one"""
+    try: return float(exc.response.headers.get('retry-after'))
+    except (AttributeError, TypeError, ValueError): return None
+
+async def _stream_request(run, batch_index, request_text, on_block):
+    """
+    Stream one completion through the limiter, handing every finished block to on_block
+    as it arrives. Retries throttles and errors with backoff; returns False if all attempts failed.
+    """
+    for attempt in range(TRANSLATE_RETRIES):
+        if attempt:
+            run.metrics['retries'] += 1
+            metrics.inc('torrentmaker_retries_total', component='translate')
+        await run.limiter.acquire()
+        started = time.time(); outcome = 'error'; delay = None; usage = None
+        try:
+            stream = await run.client.chat.completions.create(
+                model="deepseek-chat",
+                messages=[
+                    {"role": "system", "content": TRANSLATION_SYSTEM_PROMPT},
+                    {"role": "user", "content": f"Please translate the following subtitle segment.:\n\n{request_text}"},
+                ],
+                stream=True,
+                stream_options={"include_usage": True},
+                temperature=1.3
+            )
+            parser = SrtStreamParser()
+            async for chunk in stream:
+                usage = getattr(chunk, 'usage', None) or usage
+                if chunk.choices and chunk.choices[0].delta.content:
+                    for block in parser.feed(chunk.choices[0].delta.content): on_block(block)
+            for block in parser.close(): on_block(block)
+            outcome = 'ok'
+        except (RateLimitError, APITimeoutError) as e:
+            outcome = 'throttled'; delay = _retry_after(e)
+        except Exception:
+            pass
+        finally:
+            await run.limiter.release(outcome)
+        run.record_request(batch_index, time.time() - started, outcome, usage)
+        if outcome == 'ok': return True
+        if attempt < TRANSLATE_RETRIES - 1:
+            await asyncio.sleep(delay if delay is not None else backoff_delay(attempt))
+    return False
+
+async def _translate_srt_batch(run, batch_index, batch_blocks):
+    """
+    Validate each streamed cue against the source index and timecode; only cues that are
+    missing or corrupted are re-requested. Cues that never validate keep their original text.
+    """
+    cues = [parse_srt_cue(b) for b in batch_blocks]
+    positions = {}
+    for i, cue in enumerate(cues):
+        if cue: positions.setdefault((cue[0], cue[1]), []).append(i)
+    todo = [i for i, cue in enumerate(cues) if cue]  # Malformed source blocks pass through untouched
+    translated = {}
+
+    def on_block(block):
+        cue = parse_srt_cue(block)
+        if not cue or not cue[2] or '-->' in cue[2]: return
+        for i in positions.get((cue[0], cue[1]), []):
+            if i in todo and i not in translated:
+                translated[i] = cue[2]; break
+
+    for round_no in range(TRANSLATE_REPAIR_ROUNDS + 1):
+        if round_no:
+            run.metrics['repair_requests'] += 1
+            log_task(run.task_id, f"🔧 Batch {batch_index}: re-requesting {len(todo)} missing/corrupted cues")
+        before = len(translated)
+        ok = await _stream_request(run, batch_index, "\n\n".join(batch_blocks[i] for i in todo), on_block)
+        if round_no: run.metrics['repaired_cues'] += len(translated) - before
+        todo = [i for i in todo if i not in translated]
+        if not ok or not todo: break
+
+    if todo: run.metrics['fallback_cues'] += len(todo)
+    if not translated: run.metrics['failed_batches'] += 1
+    await asyncio.to_thread(translation_memory.put_many, [(cues[i][2], text) for i, text in translated.items() if cues[i][2]])
+    return "\n\n".join(f"{cues[i][0]}\n{cues[i][1]}\n{translated[i]}" if i in translated else block
+                       for i, block in enumerate(batch_blocks))
+
+async def _translate_text_batch(run, batch_index, batch_blocks):
+    """Plain text has no cue ids: accept the reply only if it has one line per source line"""
+    for round_no in range(TRANSLATE_REPAIR_ROUNDS + 1):
+        if round_no: run.metrics['repair_requests'] += 1
+        lines = []
+        ok = await _stream_request(run, batch_index, "\n\n".join(batch_blocks), lambda b: lines.extend(l.strip() for l in b.split('\n') if l.strip()))
+        if ok and len(lines) == len(batch_blocks):
+            await asyncio.to_thread(translation_memory.put_many, list(zip(batch_blocks, lines)))
+            return "\n\n".join(lines)
+        if not ok: break
+    # Fallback: Return to original text
+    run.metrics['failed_batches'] += 1; run.metrics['fallback_cues'] += len(batch_blocks)
+    return "\n\n".join(batch_blocks)
+
+async def _process_batch(run, batch_index, batch_blocks):
+    """
+    Subroutine for processing individual batches, returning (index, translated_text).
+    Batches whose every cue is in the translation memory skip the API call.
+    """
+    with stage_span('translate_batch', run.task_id):
+        return await _translate_batch(run, batch_index, batch_blocks)
+
+async def _translate_batch(run, batch_index, batch_blocks):
+    sources = _cue_sources(batch_blocks, run.is_srt)
+    cached = await asyncio.to_thread(translation_memory.get_many, sources)
+    from_memory = _render_from_memory(batch_blocks, run.is_srt, cached)
+    hits = sum(1 for src in sources if src in cached)
+    run.tm['hits'] += hits; run.tm['misses'] += len(sources) - hits
+    if from_memory is not None:
+        run.tm['skipped_calls'] += 1
+        return batch_index, from_memory
+    if run.is_srt: return batch_index, await _translate_srt_batch(run, batch_index, batch_blocks)
+    return batch_index, await _translate_text_batch(run, batch_index, batch_blocks)
+
+def background_translate(task_id, file_path, api_key=None):
     log_task(task_id, f"Commencing processing of the document: {os.path.basename(file_path)}")
     
-    if not DEEPSEEK_API_KEY:
+    api_key = api_key or DEEPSEEK_API_KEY
+    if not api_key:
         log_task(task_id, "❌ Error: Not configured DeepSeek API Key")
         task_store[task_id]['status'] = 'error'
         return
 
-    client = OpenAI(api_key=DEEPSEEK_API_KEY, base_url=DEEPSEEK_BASE_URL)
     filename = os.path.basename(file_path)
     is_srt = filename.lower().endswith('.srt')
+    dir_name, base_name = os.path.split(file_path)
+    name_part, ext_part = os.path.splitext(base_name)
+    new_filename = f"{name_part}.chi{ext_part}"
+    new_path = os.path.join(dir_name, new_filename)
+    # Hidden next to the output, so the file list does not show it
+    checkpoint_path = os.path.join(dir_name, f".{new_filename}.progress")
     
     try:
-        # Read the contents of the file
-        with open(file_path, 'r', encoding='utf-8', errors='ignore') as f:
-            full_content = f.read()
-
-        if not full_content.strip():
+        st = os.stat(file_path)
+        batches = iter_translation_batches(file_path, is_srt)
+        first = next(batches, None)
+        if first is None:
             log_task(task_id, "The file contents are empty.")
             task_store[task_id]['status'] = 'done'
             return
+        log_task(task_id, "SRT subtitles detected, streaming by timeline..." if is_srt else "Plain text mode, processed line by line...")
 
-        blocks = []
-        if is_srt:
-            log_task(task_id, "SRT subtitles detected, currently segmenting by timeline...")
-            # Uniform line break
-            full_content = full_content.replace('\r\n', '\n').replace('\r', '\n')
-            # Split SRT blocks by double line breaks
-            blocks = re.split(r'\n\s*\n', full_content)
-            blocks = [b.strip() for b in blocks if b.strip()]
-            log_task(task_id, f"Parsing complete. A total of {len(blocks)} subtitle segments.")
+        # Resume from the last flushed batch if a checkpoint for this exact source exists
+        signature = {'source': [st.st_size, st.st_mtime_ns], 'srt': is_srt, 'batching': f"tokens:{TRANSLATE_BATCH_TOKENS}:{TRANSLATE_MAX_CUES}"}
+        state = _load_translation_checkpoint(checkpoint_path, signature, new_path)
+        if state:
+            log_task(task_id, f"♻️ Resuming from batch {state['next_batch']} (checkpoint found)")
         else:
-            log_task(task_id, "Plain text mode, processed line by line...")
-            blocks = [line.strip() for line in full_content.split('\n') if line.strip()]
-
-        # Batch configuration
-        BATCH_SIZE = 30  # Slightly reduce the volume of requests per transaction
-        total_batches = (len(blocks) + BATCH_SIZE - 1) // BATCH_SIZE
-        
-        # 定义独立的批次处理函数
-        def _process_batch(batch_index, batch_blocks):
-            """
-            Subroutine for processing individual batches, returning (index, translated_text)
-            """
-            batch_input_text = "\n\n".join(batch_blocks)
-            
-            system_prompt = (
-                "You are a multilingual film subtitling expert. I shall send you the original SRT file complete with timecodes."
-                "Please translate the dialogue into fluent, natural Simplified Chinese, taking into account the context."
-                "**Strictly adhere to the following formatting rules**："
-                "1. **The original numbering and timeline must be retained without exception.** Modifying the figures is strictly prohibited."
-                "2. Replace only the foreign-language dialogue beneath the timeline with its Chinese translation."
-                "3. Retain the original SRT format structure (number-time-text), with blank lines separating paragraphs."
-                "4. Do not output any explanatory text; output only the translated SRT content."
-            )
-            
-            retry_count = 0
-            while retry_count < 3:
-                try:
-                    response = client.chat.completions.create(
-                        model="deepseek-chat",
-                        messages=[
-                            {"role": "system", "content": system_prompt},
-                            {"role": "user", "content": f"Please translate the following subtitle segment.:\n\n{batch_input_text}"},
-                        ],
-                        stream=False,
-                        temperature=1.3
-                    )
-                    res_raw = response.choices[0].message.content.strip()
-                    res_raw = res_raw.replace('```srt', '').replace('```', '').strip()
-                    
-                    if res_raw:
-                        return batch_index, res_raw
-                    else:
-                        raise ValueError("AI 返回内容为空")
-                except Exception as e:
-                    retry_count += 1
-            
-            # Fallback: Return to original text
-            return batch_index, batch_input_text
-
-        # Prepare all batch data
-        all_batches = []
-        for i in range(0, len(blocks), BATCH_SIZE):
-            batch_data = blocks[i:i + BATCH_SIZE]
-            batch_index = i // BATCH_SIZE
-            all_batches.append((batch_index, batch_data))
-
-        translated_results = [None] * len(all_batches) # Pre-allocated slots
-        completed_count = 0
-        
-        # Concurrent Execution Configuration
-        MAX_WORKERS = 8 # It is recommended to set it between 5 and 10.
-        
-        log_task(task_id, f"🚀 Enable concurrent translation, number of threads: {MAX_WORKERS}，Total {total_batches} batches...")
-
-        with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-            # Submit all tasks
-            future_to_batch = {
-                executor.submit(_process_batch, b_idx, b_data): b_idx 
-                for b_idx, b_data in all_batches
-            }
-            
-            for future in as_completed(future_to_batch):
-                b_idx = future_to_batch[future]
-                try:
-                    idx, content = future.result()
-                    translated_results[idx] = content
-                    completed_count += 1
-                    
-                    # Progress Update
-                    if completed_count % 5 == 0 or completed_count == total_batches:
-                         progress = (completed_count / total_batches) * 100
-                         log_task(task_id, f"Progress: {progress:.1f}% ({completed_count}/{total_batches})")
-                         
-                except Exception as exc:
-                    log_task(task_id, f"❌ 批次 {b_idx} 发生异常: {exc}")
-                    translated_results[b_idx] = "\n\n".join(all_batches[b_idx][1])
-
-        # Verify that all batches have been successfully processed.
-        if any(r is None for r in translated_results):
-             log_task(task_id, "⚠️ Warning: Some batches may be missing; attempts are being made to rectify this....")
-             for i, res in enumerate(translated_results):
-                 if res is None:
-                     translated_results[i] = "\n\n".join(all_batches[i][1])
-
-        # Save file
-        dir_name, base_name = os.path.split(file_path)
-        name_part, ext_part = os.path.splitext(base_name)
-        new_filename = f"{name_part}.chi{ext_part}"
-        new_path = os.path.join(dir_name, new_filename)
-
-        log_task(task_id, "Translation complete, currently concatenating and writing to file....")
-
-        final_content = "\n\n".join(translated_results)
-        with open(new_path, 'w', encoding='utf-8') as f:
-            f.write(final_content)
+            state = {'signature': signature, 'next_batch': 0, 'output_bytes': 0}
+        out = open(new_path, 'r+b' if state['output_bytes'] else 'wb')
+        out.truncate(state['output_bytes']); out.seek(state['output_bytes'])
+        try:
+            run = asyncio.run(translate_to_output(task_id, is_srt, first, batches, state, out, checkpoint_path, st.st_size, api_key))
+        finally:
+            out.close()
+        if os.path.exists(checkpoint_path): os.remove(checkpoint_path)
+        snapshot = run.snapshot()
+        task_store[task_id].update(snapshot)
+        tm, m = snapshot['translation_memory'], snapshot['translation_metrics']
+        looked_up = tm['hits'] + tm['misses']
+        if looked_up:
+            log_task(task_id, f"📚 Translation memory: {tm['hits']}/{looked_up} cues cached "
+                              f"({tm['hits'] / looked_up * 100:.1f}%), {tm['skipped_calls']} API calls skipped")
+        log_task(task_id, f"📈 API: {m['requests']} requests, {m['retries']} retries, {m['throttled']} rate-limited, "
+                          f"avg {m['latency_avg']:.2f}s, {m['prompt_tokens'] + m['completion_tokens']} tokens")
 
         log_task(task_id, f"✅ All processing complete! The file has been saved as: {new_filename}")
         task_store[task_id]['status'] = 'done'
 
+    except TaskCancelled:
+        # The checkpoint is kept, so re-queuing the file resumes where it stopped
+        log_task(task_id, "⛔ Translation cancelled, progress kept for resume")
+        task_store[task_id].update({'status': 'error', 'msg': 'Task cancelled'})
     except Exception as e:
         log_task(task_id, f"💀 Fatal error: {str(e)}")
         task_store[task_id]['status'] = 'error'
 
-def upload_to_pixhost(file_path):
-    upload_url = "https://api.pixhost.to/images"
+async def translate_to_output(task_id, is_srt, first, batches, state, out, checkpoint_path, source_size, api_key):
+    """
+    Translate batches concurrently on one event loop and append them to `out` strictly in
+    order through a reorder buffer, checkpointing after every flushed batch. The AIMD
+    limiter decides how many requests are actually open. Returns the TranslationRun.
+    """
+    # The SDK's own retries are off: _stream_request retries with backoff and AIMD feedback
+    client = AsyncOpenAI(api_key=api_key, base_url=DEEPSEEK_BASE_URL, timeout=TRANSLATE_TIMEOUT, max_retries=0)
+    run = TranslationRun(task_id, client, is_srt)
+    pending = {}  # Reorder buffer: batch_index -> (text, bytes_consumed)
+    written = 0
+
+    def _write(ready):
+        """Worker thread: append, fsync and checkpoint each (text, bytes_consumed) in order"""
+        nonlocal written
+        for text, consumed in ready:
+            data = (("\n\n" if state['output_bytes'] else "") + text).encode('utf-8')
+            out.write(data); out.flush(); os.fsync(out.fileno())
+            state['output_bytes'] += len(data); state['next_batch'] += 1
+            _save_translation_checkpoint(checkpoint_path, state)
+            written += 1
+            if written % 5 == 0:
+                progress = consumed / source_size * 100 if source_size else 100.0
+                log_task(task_id, f"Progress: {progress:.1f}% ({state['next_batch']} batches written)")
+
+    async def _flush_ready():
+        # The disk I/O runs off the loop, so open streams keep being read meanwhile; flushes never
+        # overlap, as every caller awaits this before scheduling or collecting anything else
+        ready = []
+        while state['next_batch'] + len(ready) in pending: ready.append(pending.pop(state['next_batch'] + len(ready)))
+        if not ready: return
+        await asyncio.to_thread(_write, ready)
+        if task_id in task_store: task_store[task_id].update(run.snapshot()) # On the loop, which owns the run's counters
+
+    async def _collect(done):
+        for task in done:
+            b_idx, consumed, original = in_flight.pop(task)
+            try:
+                _, content = task.result()
+            except Exception as exc:
+                log_task(task_id, f"❌ 批次 {b_idx} 发生异常: {exc}")
+                content = original
+            pending[b_idx] = (content, consumed)
+        await _flush_ready()
+
+    log_task(task_id, f"🚀 Enable concurrent streaming translation, adaptive concurrency {TRANSLATE_INITIAL_WORKERS}-{TRANSLATE_MAX_WORKERS}, ~{TRANSLATE_BATCH_TOKENS} tokens per batch...")
+
+    in_flight = {}
     try:
-        with open(file_path, 'rb') as f:
-            files = {'img': f}
-            data = {"content_type": "0", "max_th_size": "400"}
-            headers = {"Accept": "application/json"}
-            
-            response = requests.post(upload_url, files=files, data=data, headers=headers, timeout=60)
-            
-            if response.status_code == 200:
-                res_json = response.json()
-                th_url = res_json.get('th_url')
-                if th_url:
-                    th_url = th_url.replace('\\/', '/')
-                    full_url = th_url.replace('/thumbs/', '/images/')
-                    full_url = full_url.replace('https://t', 'https://img')
-                    return f"[img]{full_url}[/img]"
-            else:
-                print(f"Pixhost Error: {response.text}")
-    except Exception as e:
-        print(f"Upload exception for {file_path}: {e}")
+        for b_idx, b_data, consumed in itertools.chain([first], batches):
+            if b_idx < state['next_batch']: continue
+            if task_store.get(task_id, {}).get('cancel'): raise TaskCancelled()
+            in_flight[asyncio.ensure_future(_process_batch(run, b_idx, b_data))] = (b_idx, consumed, "\n\n".join(b_data))
+            # Bounded look-ahead keeps memory flat however long the file is. Finished batches parked
+            # behind a slow one count too; the slow one is always in flight, so waiting frees room.
+            while in_flight and len(in_flight) + len(pending) >= TRANSLATE_MAX_WORKERS * 2:
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                await _collect(done)
+        while in_flight:
+            done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+            await _collect(done)
+    finally:
+        for task in in_flight: task.cancel()
+        await client.close()
+    return run
+
+# === Torrent Builder (in-process replacement for mktorrent) ===
+class TaskCancelled(Exception):
+    pass
+
+def bencode(value):
+    """Bencode int/str/bytes/list/dict values, dict keys sorted as the spec requires"""
+    if isinstance(value, bool): value = int(value)
+    if isinstance(value, int): return b"i%de" % value
+    if isinstance(value, str): value = value.encode('utf-8')
+    if isinstance(value, bytes): return b"%d:%s" % (len(value), value)
+    if isinstance(value, (list, tuple)): return b"l" + b"".join(bencode(v) for v in value) + b"e"
+    if isinstance(value, dict):
+        items = sorted((k.encode('utf-8') if isinstance(k, str) else k, v) for k, v in value.items())
+        return b"d" + b"".join(bencode(k) + bencode(v) for k, v in items) + b"e"
+    raise TypeError(f"Cannot bencode {type(value).__name__}")
+
+def scan_torrent_files(source_path):
+    """
+    List payload files the way mktorrent does: regular files only (symlinks followed),
+    sorted by relative path bytes. Returns [(abs_path, [path components], size)].
+    """
+    if os.path.isfile(source_path):
+        return [(source_path, [os.path.basename(source_path)], os.path.getsize(source_path))]
+    entries = []
+    for root, dirs, files in os.walk(source_path, followlinks=True):
+        for f in files:
+            abs_path = os.path.join(root, f)
+            if not os.path.isfile(abs_path): continue
+            rel = os.path.relpath(abs_path, source_path)
+            entries.append((os.fsencode(rel), abs_path, rel.split(os.sep), os.path.getsize(abs_path)))
+    entries.sort(key=lambda e: e[0])
+    return [(abs_path, parts, size) for _, abs_path, parts, size in entries]
+
+def auto_piece_exponent(total_size):
+    """Pick the piece size exponent so the piece count lands in (1000, 2000]; beyond ~125 GiB it grows at 64 MiB pieces"""
+    for exp in range(AUTO_PIECE_MIN_EXP, AUTO_PIECE_MAX_EXP + 1):
+        if total_size <= AUTO_PIECE_MAX_PIECES << exp: return exp
+    return AUTO_PIECE_MAX_EXP
+
+def _hash_piece_range(files, starts, piece_length, total, first, last, on_bytes, should_cancel, read_size=0):
+    """Hash pieces [first, last) with sequential readinto calls into one reused buffer"""
+    buf = bytearray(piece_length); view = memoryview(buf)
+    digests = []
+    pos = first * piece_length
+    fi = bisect.bisect_right(starts, pos) - 1
+    handle = None
+    try:
+        for _ in range(first, last):
+            if should_cancel and should_cancel(): raise TaskCancelled()
+            want = min(piece_length, total - pos)
+            filled = 0
+            while filled < want:
+                # Skip finished (and zero-length) files
+                while starts[fi] + files[fi][2] <= pos:
+                    fi += 1
+                    if handle: handle.close(); handle = None
+                if handle is None:
+                    handle = open(files[fi][0], 'rb', buffering=0)
+                    handle.seek(pos - starts[fi])
+                chunk = min(want - filled, starts[fi] + files[fi][2] - pos)
+                if read_size: chunk = min(chunk, read_size)
+                n = handle.readinto(view[filled:filled + chunk])
+                if not n: raise IOError(f"File shrank while hashing: {files[fi][0]}")
+                filled += n; pos += n
+            digests.append(hashlib.sha1(view[:want]).digest())
+            if on_bytes: on_bytes(want)
+    finally:
+        if handle: handle.close()
+        metrics.inc('torrentmaker_hashed_bytes_total', pos - first * piece_length)
+    return b"".join(digests)
+
+def hash_pieces(files, piece_length, on_bytes=None, should_cancel=None, workers=None, read_size=None):
+    """SHA-1 every piece of the concatenated payload, spreading contiguous piece runs over a thread pool"""
+    if read_size is None: read_size = HASH_READ_SIZE
+    starts = []; total = 0
+    for _, _, size in files:
+        starts.append(total); total += size
+    num_pieces = (total + piece_length - 1) // piece_length
+    per_job = max(1, HASH_JOB_BYTES // piece_length)
+    ranges = [(i, min(i + per_job, num_pieces)) for i in range(0, num_pieces, per_job)]
+    with ThreadPoolExecutor(max_workers=workers or HASH_WORKERS) as executor:
+        futures = [executor.submit(_hash_piece_range, files, starts, piece_length, total, a, b, on_bytes, should_cancel, read_size) for a, b in ranges]
+        try:
+            return b"".join(f.result() for f in futures)
+        except BaseException:
+            for f in futures: f.cancel()
+            raise
+
+def _piece_fingerprint(files, piece_length):
+    """Identity of a payload version: every file's path, size, mtime and inode plus the piece length"""
+    stats = []
+    for abs_path, parts, size in files:
+        st = os.stat(abs_path)
+        stats.append(["/".join(parts), size, st.st_mtime_ns, st.st_ino])
+    return json.dumps({'piece_length': piece_length, 'files': stats}, separators=(',', ':')).encode('utf-8')
+
+def cached_piece_hashes(source_path, files, piece_length, on_bytes=None, should_cancel=None):
+    """
+    Return (pieces, from_cache). Entries are keyed by source path and piece length and
+    store the payload fingerprint; a changed file invalidates the entry.
+    """
+    key = f"{os.path.abspath(source_path)}|{piece_length}"
+    fingerprint = _piece_fingerprint(files, piece_length)
+    data = piece_cache.get(key)
+    if data is not None:
+        header, _, pieces = data.partition(b"\n")
+        if header == fingerprint:
+            metrics.inc('torrentmaker_piece_cache_total', result='hit')
+            if on_bytes: on_bytes(sum(size for _, _, size in files))
+            return pieces, True
+        piece_cache.delete(key)
+    metrics.inc('torrentmaker_piece_cache_total', result='miss')
+    pieces = hash_pieces(files, piece_length, on_bytes, should_cancel)
+    # Only cache if nothing changed underneath us while hashing
+    if _piece_fingerprint(files, piece_length) == fingerprint:
+        piece_cache.put(key, fingerprint + b"\n" + pieces)
+    return pieces, False
+
+def build_torrent(source_path, output_path, tracker_url, piece_exp, is_private=False, comment=None, files=None, on_bytes=None, should_cancel=None):
+    """
+    Write a .torrent equivalent to `mktorrent -l <piece_exp> -a <tracker> [-p] [-c <comment>]`.
+    Comma-separated trackers become one announce-list tier, like mktorrent's -a.
+    Returns True when the piece hashes were reused from the piece cache.
+    """
+    piece_exp = int(piece_exp)
+    if not 15 <= piece_exp <= 28: raise ValueError("The piece length must be a number between 15 and 28.")
+    piece_length = 1 << piece_exp
+    if files is None: files = scan_torrent_files(source_path)
+    pieces, from_cache = cached_piece_hashes(source_path, files, piece_length, on_bytes, should_cancel)
+
+    info = {'name': os.path.basename(source_path.rstrip('/')), 'piece length': piece_length, 'pieces': pieces}
+    if os.path.isfile(source_path): info['length'] = files[0][2]
+    else: info['files'] = [{'length': size, 'path': parts} for _, parts, size in files]
+    if is_private: info['private'] = 1
+
+    meta = {'created by': TORRENT_CREATED_BY, 'creation date': int(time.time()), 'info': info}
+    trackers = [t.strip() for t in (tracker_url or '').split(',') if t.strip()]
+    if trackers: meta['announce'] = trackers[0]
+    if len(trackers) > 1: meta['announce-list'] = [trackers]
+    if comment: meta['comment'] = comment
+
+    tmp_path = output_path + ".part"
+    with open(tmp_path, 'wb') as f: f.write(bencode(meta))
+    os.replace(tmp_path, output_path)
+    return from_cache
+
+def make_hash_progress(task_id, total_bytes):
+    """Returns an on_bytes callback that publishes hashed bytes and throughput into task_store"""
+    lock = threading.Lock()
+    state = {'done': 0, 'started': time.time(), 'reported': 0.0}
+    def on_bytes(n):
+        with lock:
+            state['done'] += n
+            now = time.time()
+            if now - state['reported'] < 0.5 and state['done'] < total_bytes: return
+            state['reported'] = now
+            elapsed = max(now - state['started'], 1e-6)
+            rate = state['done'] / elapsed
+            pct = (state['done'] / total_bytes * 100) if total_bytes else 100.0
+        if task_id in task_store:
+            task_store[task_id]['hash'] = {'done': state['done'], 'total': total_bytes, 'rate': rate}
+            task_store[task_id]['msg'] = f"Generating torrent... {pct:.1f}% ({rate / 1048576:.1f} MB/s)"
+    return on_bytes
+
+def upload_to_pixhost(file_path, stats=None):
+    """Upload one image over the pooled session, retrying network errors, 429 and 5xx with jittered backoff"""
+    for attempt in range(PIXHOST_RETRIES):
+        if stats is not None: stats['attempts'] = attempt + 1
+        retry = False
+        try:
+            with open(file_path, 'rb') as f:
+                files = {'img': f}
+                data = {"content_type": "0", "max_th_size": "400"}
+                headers = {"Accept": "application/json"}
+                
+                response = http_session.post(PIXHOST_UPLOAD_URL, files=files, data=data, headers=headers, timeout=60)
+                
+                if response.status_code == 200:
+                    res_json = response.json()
+                    th_url = res_json.get('th_url')
+                    if th_url:
+                        th_url = th_url.replace('\\/', '/')
+                        full_url = th_url.replace('/thumbs/', '/images/')
+                        full_url = full_url.replace('https://t', 'https://img')
+                        return f"[img]{full_url}[/img]"
+                else:
+                    print(f"Pixhost Error: {response.text}")
+                    retry = response.status_code == 429 or response.status_code >= 500
+        except Exception as e:
+            print(f"Upload exception for {file_path}: {e}")
+            retry = True
+        if not retry or attempt == PIXHOST_RETRIES - 1: break
+        metrics.inc('torrentmaker_retries_total', component='pixhost')
+        time.sleep(backoff_delay(attempt))
     return None
 
-def generate_screenshots(video_path, output_base_path, mode, quality):
-    temp_dir = "/tmp/temp_thumbs_processing"
+def upload_images(task_id, image_files):
+    """Upload on a small thread pool; returns the BBCode lines in frame order and per-image timings"""
+    def _upload(img_p):
+        stats = {'file': os.path.basename(img_p), 'attempts': 0}
+        started = time.time()
+        with stage_span('upload_image', task_id): stats['bbcode'] = upload_to_pixhost(img_p, stats)
+        stats['seconds'] = round(time.time() - started, 3)
+        return stats
+    with ThreadPoolExecutor(max_workers=max(1, min(PIXHOST_WORKERS, len(image_files)))) as executor:
+        results = list(executor.map(_upload, image_files))
+    timings = [{'file': r['file'], 'seconds': r['seconds'], 'attempts': r['attempts'], 'ok': bool(r['bbcode'])} for r in results]
+    return [r['bbcode'] for r in results if r['bbcode']], timings
+
+# === Screenshot extraction ===
+def _frame_ok(path):
+    return os.path.exists(path) and os.path.getsize(path) > 0
+
+# showinfo@shotN is named per input, so its frame stats map back to the timestamp that produced them.
+# showinfo reports in the frame's own bit depth, so frames are brought to 8-bit YUV first (10-bit HDR
+# sources would otherwise read 4x too bright) without touching the chroma layout of 8-bit sources.
+_SHOT_8BIT = "format=pix_fmts=yuv420p|yuvj420p|yuv422p|yuvj422p|yuv444p|yuvj444p"
+_SHOWINFO_STATS = re.compile(r"\[showinfo@shot(\d+) @ [^\]]*\] n:\s*\d+ .*? mean:\[(\d+)[^\]]*\] stdev:\[([\d.]+)")
+
+def _frame_stats(stderr):
+    """{input index: (luma mean, luma stdev)} from an ffmpeg run's showinfo@shotN lines"""
+    return {int(m.group(1)): (int(m.group(2)), float(m.group(3))) for m in _SHOWINFO_STATS.finditer(stderr or "")}
+
+def _is_blank(stats):
+    mean, stdev = stats
+    return stdev < SHOT_FLAT_STDEV or (mean < SHOT_DARK_MEAN and stdev < SHOT_DARK_STDEV)
+
+def _nudged(timestamp, duration, round_no):
+    """Replacement timestamp for a blank frame: later, earlier, further later, ... clamped inside the video"""
+    step = duration * SHOT_NUDGE * (round_no // 2 + 1)
+    return min(max(timestamp + (step if round_no % 2 == 0 else -step), 1), max(1, duration - 1))
+
+def _decode_args(keyframes):
+    """Input options for one frame grab; with `keyframes` only the keyframe at or before the seek point is decoded"""
+    args = ["-threads", str(SHOT_DECODE_THREADS)]
+    if keyframes: args += ["-skip_frame", "nokey", "-noaccurate_seek"]
+    return args
+
+def _capture_frame(video_path, timestamp, img_path, q_val, width=0, extra_flags=(), keyframes=False):
+    """Per-frame path: one ffmpeg launch, input seek to the timestamp, one output frame"""
+    cmd = ["ffmpeg"] + _decode_args(keyframes) + ["-ss", str(timestamp), "-y", "-i", video_path, "-frames:v", "1", "-qscale:v", str(q_val)]
+    cmd.extend(extra_flags)
+    if width > 0: cmd.extend(["-vf", f"scale={width}:-1"])
+    cmd.append(img_path)
+    with ffmpeg_slots, stage_span('capture'): run_cmd(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    return _frame_ok(img_path)
+
+def _capture_frames_parallel(video_path, jobs, q_val, width=0, extra_flags=(), keyframes=False):
+    """Per-frame path on a worker pool; jobs are (timestamp, img_path). Returns one success flag per job, in order"""
+    with ThreadPoolExecutor(max_workers=max(1, min(FFMPEG_WORKERS, len(jobs)))) as executor:
+        futures = [executor.submit(_capture_frame, video_path, ts, img_path, q_val, width, extra_flags, keyframes) for ts, img_path in jobs]
+        return [f.result() for f in futures]
+
+def _seek_inputs(video_path, timestamps, keyframes=False):
+    """One input per timestamp, each with its own keyframe seek, all decoded inside a single ffmpeg process"""
+    args = []
+    for ts in timestamps: args.extend(_decode_args(keyframes) + ["-ss", str(ts), "-i", video_path])
+    return args
+
+def capture_grid_single_pass(video_path, timestamps, width, q_val, output_jpg, keyframes=False):
+    """
+    Grab every grid frame and tile them 4x4 in one ffmpeg invocation. Returns the per-frame
+    luma stats, or None when a seek produced nothing (the grid is then removed).
+    """
+    # trim first, so scale and showinfo only ever see the one frame kept per input
+    chains = [f"[{i}:v]trim=end_frame=1,setpts=PTS-STARTPTS,scale={width}:-1,setsar=1,{_SHOT_8BIT},showinfo@shot{i}[f{i}]" for i in range(len(timestamps))]
+    joined = "".join(f"[f{i}]" for i in range(len(timestamps)))
+    graph = ";".join(chains) + f";{joined}concat=n={len(timestamps)}:v=1:a=0,tile=4x4:padding=5:color=white[grid]"
+    cmd = ["ffmpeg", "-y"] + _seek_inputs(video_path, timestamps, keyframes)
+    cmd += ["-filter_complex", graph, "-map", "[grid]", "-frames:v", "1", "-qscale:v", str(q_val), output_jpg]
+    with ffmpeg_slots, stage_span('capture_grid'):
+        result = run_cmd(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='ignore')
+    stats = _frame_stats(result.stderr)
+    if result.returncode != 0 or len(stats) < len(timestamps) or not _frame_ok(output_jpg):
+        if os.path.exists(output_jpg): os.remove(output_jpg)
+        return None
+    return stats
+
+def capture_frames_single_pass(video_path, timestamps, img_paths, q_val, width=0, extra_flags=(), keyframes=False):
+    """Grab one frame per timestamp into its own file from a single ffmpeg invocation; returns {path written: luma stats}"""
+    scale = f",scale={width}:-1" if width > 0 else ""
+    graph = ";".join(f"[{i}:v]trim=end_frame=1,setpts=PTS-STARTPTS{scale},{_SHOT_8BIT},showinfo@shot{i}[s{i}]" for i in range(len(timestamps)))
+    cmd = ["ffmpeg", "-y"] + _seek_inputs(video_path, timestamps, keyframes) + ["-filter_complex", graph]
+    for i, img_path in enumerate(img_paths):
+        cmd += ["-map", f"[s{i}]", "-frames:v", "1", "-qscale:v", str(q_val)] + list(extra_flags) + [img_path]
+    with ffmpeg_slots, stage_span('capture_frames'):
+        result = run_cmd(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='ignore')
+    stats = _frame_stats(result.stderr)
+    return {p: stats.get(i) for i, p in enumerate(img_paths) if _frame_ok(p)}
+
+def _grid_without_blanks(video_path, timestamps, duration, width, q_val, output_jpg, stats, keyframes):
+    """
+    Re-capture only the blank grid cells at nudged timestamps and overlay the replacements that
+    are not blank themselves onto the grid, in one re-encode after the last round
+    """
+    blank = sorted(i for i, frame in stats.items() if _is_blank(frame))
+    replacements = {} # cell index -> lossless replacement frame
+    try:
+        for round_no in range(SHOT_RETRY_ROUNDS):
+            if not blank: break
+            paths = [f"{output_jpg}.cell{i}.png" for i in blank]
+            retried = capture_frames_single_pass(video_path, [_nudged(timestamps[i], duration, round_no) for i in blank],
+                                                 paths, q_val, width, keyframes=keyframes)
+            for i, path in zip(blank, paths):
+                frame = retried.get(path)
+                if frame is not None and not _is_blank(frame): replacements[i] = path
+                elif os.path.exists(path): os.remove(path)
+            blank = [i for i in blank if i not in replacements]
+        if not replacements: return
+        # Same layout as tile=4x4:padding=5 in capture_grid_single_pass; cells share one size.
+        # format=rgb: blending in yuv420 squeezes the JPEG grid's full range on the overlaid cells only
+        cells = sorted(replacements)
+        graph = ";".join(f"[{'0:v' if n == 0 else f'g{n}'}][{n + 1}:v]overlay=x={i % 4}*({width}+5):y={i // 4}*(overlay_h+5):format=rgb[g{n + 1}]"
+                         for n, i in enumerate(cells))
+        cmd = ["ffmpeg", "-y", "-i", output_jpg]
+        for i in cells: cmd += ["-i", replacements[i]]
+        candidate = output_jpg + ".retry.jpg"
+        cmd += ["-filter_complex", graph, "-map", f"[g{len(cells)}]", "-frames:v", "1", "-qscale:v", str(q_val), candidate]
+        with ffmpeg_slots, stage_span('capture_grid'): run_cmd(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if _frame_ok(candidate): os.replace(candidate, output_jpg)
+        elif os.path.exists(candidate): os.remove(candidate)
+    finally:
+        for path in replacements.values():
+            if os.path.exists(path): os.remove(path)
+
+def _frames_without_blanks(video_path, timestamps, img_paths, duration, q_val, width, extra_flags, captured, keyframes):
+    """Re-capture blank shots at nudged timestamps; a replacement only lands if it is not blank itself"""
+    index = {p: i for i, p in enumerate(img_paths)}
+    for round_no in range(SHOT_RETRY_ROUNDS):
+        blank = [p for p, frame in captured.items() if frame is not None and _is_blank(frame)]
+        if not blank: break
+        retry_paths = [f"{p}.retry.jpg" for p in blank]
+        retried = capture_frames_single_pass(video_path, [_nudged(timestamps[index[p]], duration, round_no) for p in blank],
+                                             retry_paths, q_val, width, extra_flags, keyframes)
+        for p, retry_path in zip(blank, retry_paths):
+            frame = retried.get(retry_path)
+            if frame is not None and not _is_blank(frame):
+                os.replace(retry_path, p)
+                captured[p] = frame
+            elif os.path.exists(retry_path): os.remove(retry_path)
+
+_METADATA_LINE = re.compile(r"\] (?:frame:\d+\s+pts:\S+\s+pts_time:(\S+)|lavfi\.(scene_score|signalstats\.\w+)=(\S+))")
+
+def analyze_scenes(video_path):
+    """
+    One low-resolution pass over the keyframes only: [[time, scene score, YAVG, YLOW, YHIGH], ...].
+    Cached per file version with the probe results, so other qualities and modes reuse it.
+    """
+    keys = ('scene_score', 'signalstats.YAVG', 'signalstats.YLOW', 'signalstats.YHIGH')
+    def _run():
+        printers = ",".join(f"metadata=mode=print:key=lavfi.{key}" for key in keys)
+        cmd = ["ffmpeg", "-nostats"] + _decode_args(True) + ["-i", video_path, "-an", "-sn", "-dn",
+               "-vf", f"scale={SCENE_ANALYSIS_WIDTH}:-2,select='gte(scene,0)',signalstats,{printers}", "-f", "null", "-"]
+        with ffmpeg_slots, stage_span('scene_analysis'):
+            result = run_cmd(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, errors='ignore')
+        if result.returncode != 0: return None
+        frames = {}
+        current = None
+        for m in _METADATA_LINE.finditer(result.stderr):
+            if m.group(1) is not None: current = frames.setdefault(float(m.group(1)), {})
+            elif current is not None: current[m.group(2)] = float(m.group(3))
+        rows = [[t] + [stats[key] for key in keys] for t, stats in sorted(frames.items()) if all(key in stats for key in keys)]
+        return rows or None
+    try: return _cached_probe(video_path, f'scenes:{SCENE_ANALYSIS_WIDTH}', _run)
+    except OSError: return None
+
+def pick_scene_timestamps(frames, duration, count):
+    """
+    Split the usable part of the runtime into `count` slots and take, per slot, the keyframe
+    that differs most from its predecessor and has the most contrast, skipping dark or flat
+    frames and, where possible, near-copies of the previous pick. A slot without candidates
+    takes the unpicked usable keyframe nearest its middle, or the middle itself; no time is
+    picked twice.
+    """
+    start, end = duration * SCENE_WINDOW[0], duration * SCENE_WINDOW[1]
+    slot = (end - start) / count
+    usable = [f for f in frames if f[2] >= SCENE_MIN_YAVG and f[4] - f[3] >= SCENE_MIN_CONTRAST]
+    picks, previous = [], None
+    for k in range(count):
+        lo, hi = start + k * slot, start + (k + 1) * slot
+        candidates = [f for f in usable if lo <= f[0] < hi and f[0] not in picks] # An earlier slot's fallback may have taken one
+        distinct = [f for f in candidates if not (previous and all(abs(a - b) < 2 for a, b in zip(f[2:], previous[2:])))]
+        best = max(distinct or candidates, key=lambda f: f[1] + (f[4] - f[3]) / 255, default=None)
+        if best is None:
+            middle = lo + slot / 2
+            best = min((f for f in usable if f[0] not in picks), key=lambda f: abs(f[0] - middle), default=None)
+        picks.append(best[0] if best else lo + slot / 2)
+        previous = best or previous
+    return sorted(picks)
+
+def scene_timestamps(video_path, duration, count):
+    """`count` scene-picked capture times, or None when the analysis failed or found too few keyframes"""
+    frames = analyze_scenes(video_path)
+    return pick_scene_timestamps(frames, duration, count) if frames and len(frames) >= count else None
+
+def generate_screenshots(video_path, output_base_path, mode, quality, work_dir=None, seek=None, sampling=None):
+    # Frames go into the task's own workspace so concurrent tasks never share scratch files
+    owns_dir = work_dir is None
+    temp_dir = make_task_workspace("shots") if owns_dir else work_dir
     settings_grid = {'small': (320, 15), 'medium': (640, 5), 'large': (1280, 2)}
     settings_full = {'medium': (1920, 1, ["-qmin", "1", "-qmax", "1"]), 'large': (0, 1, ["-qmin", "1", "-qmax", "1"])}
+    keyframes = (seek or SHOT_SEEK) == 'keyframe'
+    by_scene = (sampling or SHOT_SAMPLING) == 'scene'
     generated_images = []
 
     try:
-        if os.path.exists(temp_dir): shutil.rmtree(temp_dir)
-        os.makedirs(temp_dir, exist_ok=True)
         duration = get_video_duration(video_path)
         if duration < 60: return "success", "Video too short, skipping screenshot"
         
@@ -279,179 +1521,935 @@ def generate_screenshots(video_path, output_base_path, mode, quality):
         if mode == 'grid':
             width, q_val = settings_grid.get(quality, (640, 5))
             output_jpg = output_base_path + "_Thumb.jpg"
-            blank_img = os.path.join(temp_dir, "blank.jpg")
-            subprocess.run(["ffmpeg", "-f", "lavfi", "-i", f"color=c=black:s={width}x{int(width*9/16)}", "-frames:v", "1", "-y", blank_img], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
             interval = duration / 16
-            for i in range(16):
-                timestamp = (i * interval) + (interval / 2)
-                img_path = os.path.join(temp_dir, f"img_{i:02d}.jpg")
-                cmd = ["ffmpeg", "-ss", str(timestamp), "-y", "-i", video_path, "-frames:v", "1", "-qscale:v", str(q_val), "-vf", f"scale={width}:-1", img_path]
-                subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                if not os.path.exists(img_path) or os.path.getsize(img_path) == 0: shutil.copy(blank_img, img_path)
-            cmd_tile = ["ffmpeg", "-y", "-i", os.path.join(temp_dir, "img_%02d.jpg"), "-vf", "tile=4x4:padding=5:color=white", "-qscale:v", str(q_val), output_jpg]
-            subprocess.run(cmd_tile, capture_output=True)
+            timestamps = (by_scene and scene_timestamps(video_path, duration, 16)) or [(i * interval) + (interval / 2) for i in range(16)]
+            stats = capture_grid_single_pass(video_path, timestamps, width, q_val, output_jpg, keyframes)
+            if stats is not None:
+                _grid_without_blanks(video_path, timestamps, duration, width, q_val, output_jpg, stats, keyframes)
+            else:
+                # Fallback: one ffmpeg per frame on the worker pool, nearby timestamps for misses, then tile
+                jobs = [(ts, os.path.join(temp_dir, f"img_{i:02d}.jpg")) for i, ts in enumerate(timestamps)]
+                for (ts, img_path), ok in zip(jobs, _capture_frames_parallel(video_path, jobs, q_val, width, keyframes=keyframes)):
+                    for round_no in range(SHOT_RETRY_ROUNDS):
+                        if ok: break
+                        ok = _capture_frame(video_path, _nudged(ts, duration, round_no), img_path, q_val, width, keyframes=keyframes)
+                    if not ok: # Last resort, so the tile still has 16 cells
+                        run_cmd(["ffmpeg", "-f", "lavfi", "-i", f"color=c=black:s={width}x{int(width*9/16)}", "-frames:v", "1", "-y", img_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+                cmd_tile = ["ffmpeg", "-y", "-i", os.path.join(temp_dir, "img_%02d.jpg"), "-vf", "tile=4x4:padding=5:color=white", "-qscale:v", str(q_val), output_jpg]
+                with stage_span('tile'): run_cmd(cmd_tile, capture_output=True)
             if os.path.exists(output_jpg): 
                 result_file = output_jpg; preview_data = output_jpg
                 generated_images.append(output_jpg) 
             else: return "error", "Puzzle generation failed"
         else:
             target_width, q_val, extra_flags = settings_full.get(quality, (1920, 1, []))
-            image_list = []
             steps = 7
-            for i in range(1, steps):
-                timestamp = duration * (i / steps)
-                img_path = f"{output_base_path}_shot_{i}.jpg"
-                cmd = ["ffmpeg", "-ss", str(timestamp), "-y", "-i", video_path, "-frames:v", "1", "-qscale:v", str(q_val)]
-                cmd.extend(extra_flags)
-                if target_width > 0: cmd.extend(["-vf", f"scale={target_width}:-1"])
-                cmd.append(img_path)
-                subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-                if os.path.exists(img_path) and os.path.getsize(img_path) > 0: 
-                    image_list.append(img_path)
-                    generated_images.append(img_path) 
+            timestamps = (by_scene and scene_timestamps(video_path, duration, steps - 1)) or [duration * (i / steps) for i in range(1, steps)]
+            img_paths = [f"{output_base_path}_shot_{i}.jpg" for i in range(1, steps)]
+            captured = capture_frames_single_pass(video_path, timestamps, img_paths, q_val, target_width, extra_flags, keyframes)
+            # Fallback: parallel per-frame capture for anything the single pass could not produce
+            missing = [(ts, p) for ts, p in zip(timestamps, img_paths) if p not in captured]
+            if missing:
+                for (_, img_path), ok in zip(missing, _capture_frames_parallel(video_path, missing, q_val, target_width, extra_flags, keyframes)):
+                    if ok: captured[img_path] = None # No stats from this path, so it is not checked for blanks
+            _frames_without_blanks(video_path, timestamps, img_paths, duration, q_val, target_width, extra_flags, captured, keyframes)
+            image_list = [p for p in img_paths if p in captured]
+            generated_images.extend(image_list)
             
-            zip_path = output_base_path + "_Screenshots.zip"
+            # The archive is virtual: /download streams it from the shot files on request
+            zip_path = output_base_path + SHOTS_ZIP_SUFFIX
             if image_list:
-                with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-                    for img in image_list: zipf.write(img, os.path.basename(img))
                 result_file = zip_path; preview_data = image_list[0] if len(image_list) > 0 else None
             else: return "error", "截图失败"
         
         return "success", {"file": result_file, "preview": preview_data, "images": generated_images}
     except Exception as e: return "error", str(e)
     finally:
-        if os.path.exists(temp_dir): shutil.rmtree(temp_dir)
+        if owns_dir: shutil.rmtree(temp_dir, ignore_errors=True)
+
+# === Seeding pipeline: stages shared by single and batch tasks ===
+def default_output_folder(full_source_path):
+    """Results go to a torrent/ folder inside the source folder, or next to a single file"""
+    parent = full_source_path if os.path.isdir(full_source_path) else os.path.dirname(full_source_path)
+    return os.path.join(parent, "torrent")
+
+def prepare_seed_item(full_source_path, output_folder, label=""):
+    """Output paths for one source; removes results of a previous run"""
+    if not os.path.exists(output_folder): os.makedirs(output_folder, exist_ok=True)
+    base_name = os.path.basename(full_source_path.rstrip('/')) if os.path.isdir(full_source_path) else os.path.basename(full_source_path)
+    item = {
+        'path': full_source_path, 'name': base_name, 'label': label, 'status': 'pending', 'note': '',
+        'f_torrent': os.path.join(output_folder, f"{base_name}.torrent"),
+        'f_info': os.path.join(output_folder, f"{base_name}_MediaInfo.txt"),
+        'f_shot_base': os.path.join(output_folder, base_name),
+        'files': {}, 'images': [], 'bbcode': '', 'timings': {}, 'upload_timings': [],
+    }
+    for f in [item['f_torrent'], item['f_info'], item['f_shot_base'] + SHOTS_ZIP_SUFFIX]:
+        if os.path.exists(f): 
+            try: os.remove(f)
+            except: pass
+    for fname in os.listdir(output_folder):
+        if fname.startswith(base_name) and fname.lower().endswith(('.jpg', '.jpeg')):
+            try: os.remove(os.path.join(output_folder, fname))
+            except: pass
+    return item
+
+@contextmanager
+def seed_stage(task_id, item, name):
+    """
+    Runs one pipeline stage under a scheduler slot of its resource class, recording its wall
+    time (without the wait for the slot) in item['timings'] and as a metrics span
+    """
+    with scheduler.slot(task_id, SEED_STAGE_RESOURCES[name]):
+        start = time.time()
+        try:
+            with stage_span(name, task_id): yield
+        finally: item['timings'][name] = round(time.time() - start, 3)
+
+def seed_stage_torrent(task_id, item, tracker_url, is_private, comment, piece_size, should_cancel):
+    with seed_stage(task_id, item, 'hash'):
+        task_store[task_id]['msg'] = f"{item['label']}Generating torrent..."
+        with stage_span('scan', task_id): payload_files = scan_torrent_files(item['path'])
+        payload_size = sum(size for _, _, size in payload_files)
+        if piece_size == 'auto':
+            piece_size = auto_piece_exponent(payload_size)
+            log_task(task_id, f"{item['label']}Automatic piece size: {(1 << piece_size) // 1024} KiB")
+        on_bytes = make_hash_progress(task_id, payload_size)
+        from_cache = build_torrent(item['path'], item['f_torrent'], tracker_url, piece_size, is_private, comment,
+                                   files=payload_files, on_bytes=on_bytes, should_cancel=should_cancel)
+        if from_cache: log_task(task_id, f"{item['label']}Torrent pieces reused from the piece-hash cache")
+        if os.path.exists(item['f_torrent']): item['files']['torrent'] = item['f_torrent']
+
+def seed_stage_media(task_id, item, shot_mode, shot_quality, work_dir, shot_seek=None, shot_sampling=None):
+    """MediaInfo and screenshots of the largest video; leaves the images to upload in item['images']"""
+    with seed_stage(task_id, item, 'media'):
+        task_store[task_id]['msg'] = f"{item['label']}Scan video files..."
+        with stage_span('find_media', task_id): target_media_file = find_largest_file(item['path'])
+        if not target_media_file:
+            item['note'] = '✅ Completed (no video)'
+            return
+        task_store[task_id]['msg'] = f"{item['label']}Generate MediaInfo..."
+        with stage_span('mediainfo', task_id): info_text = get_mediainfo_text(target_media_file)
+        if info_text:
+            with open(item['f_info'], 'w', encoding='utf-8') as f: f.write(info_text)
+        if os.path.exists(item['f_info']): item['files']['info'] = item['f_info']
 
-def background_process(tracker_url, is_private, comment, piece_size, full_source_path, output_folder, task_id, shot_mode, shot_quality):
+        task_store[task_id]['msg'] = f"{item['label']}Taking a screenshot ({shot_mode}/{shot_quality})..."
+        with stage_span('screenshots', task_id, mode=shot_mode):
+            status, res = generate_screenshots(target_media_file, item['f_shot_base'], shot_mode, shot_quality, work_dir, shot_seek, shot_sampling)
+        if status != "success":
+            item['note'] = f"⚠️ Screenshot failed: {res}"
+            return
+        if isinstance(res, dict): # A plain message means screenshots were skipped (e.g. very short video)
+            if res.get('file'): item['files']['shot_download'] = res['file']
+            if res.get('preview'): item['files']['shot_preview'] = res['preview']
+            item['images'] = res.get('images', [])
+        item['note'] = '✅ All successful'
+
+def seed_stage_upload(task_id, item):
+    with seed_stage(task_id, item, 'upload'):
+        if not item['images']: return
+        task_store[task_id]['msg'] = f"{item['label']}Uploading in progress {len(item['images'])} 张图片到 Pixhost..."
+        bbcode, item['upload_timings'] = upload_images(task_id, item['images'])
+        item['bbcode'] = "\n".join(bbcode)
+
+def background_process(tracker_url, is_private, comment, piece_size, full_source_path, output_folder, task_id, shot_mode, shot_quality, shot_seek=None, shot_sampling=None):
     log_task(task_id, f"Initiate seeding task...")
-    task_store[task_id] = {'status': 'running', 'msg': 'Initialisation...', 'files': {}, 'bbcode': ''}
+    task_store.setdefault(task_id, {}).update({'status': 'running', 'msg': 'Initialisation...', 'files': {}, 'bbcode': ''})
+    work_dir = None
     try:
-        if not os.path.exists(output_folder): os.makedirs(output_folder, exist_ok=True)
-        base_name = os.path.basename(full_source_path.rstrip('/')) if os.path.isdir(full_source_path) else os.path.basename(full_source_path)
-        f_torrent = os.path.join(output_folder, f"{base_name}.torrent")
-        f_info = os.path.join(output_folder, f"{base_name}_MediaInfo.txt")
-        f_shot_base = os.path.join(output_folder, base_name)
-        
-        for f in [f_torrent, f_info, f_shot_base + "_Screenshots.zip"]:
-            if os.path.exists(f): 
-                try: os.remove(f)
-                except: pass
-        if os.path.exists(output_folder):
-            for fname in os.listdir(output_folder):
-                if fname.startswith(base_name) and fname.lower().endswith(('.jpg', '.jpeg')):
-                    try: os.remove(os.path.join(output_folder, fname))
-                    except: pass
-
-        task_store[task_id]['msg'] = 'Generating torrent...'
-        cmd = ["mktorrent", "-v", "-l", piece_size, "-a", tracker_url]
-        if is_private: cmd.append("-p")
-        if comment: cmd.extend(["-c", comment])
-        cmd.extend(["-o", f_torrent])
-        cmd.append(full_source_path)
-        subprocess.run(cmd, capture_output=True)
-        if os.path.exists(f_torrent): task_store[task_id]['files']['torrent'] = f_torrent
-
-        task_store[task_id]['msg'] = 'Scan video files...'
-        target_media_file = find_largest_file(full_source_path)
-        if target_media_file:
-            task_store[task_id]['msg'] = 'Generate MediaInfo...'
-            subprocess.run(["mediainfo", target_media_file, f"--LogFile={f_info}"], stdout=subprocess.DEVNULL)
-            if os.path.exists(f_info): task_store[task_id]['files']['info'] = f_info
-            
-            task_store[task_id]['msg'] = f'Taking a screenshot ({shot_mode}/{shot_quality})...'
-            status, res = generate_screenshots(target_media_file, f_shot_base, shot_mode, shot_quality)
-            if status == "success":
-                 if res.get('file'): task_store[task_id]['files']['shot_download'] = res['file']
-                 if res.get('preview'): task_store[task_id]['files']['shot_preview'] = res['preview']
-                 
-                 image_files = res.get('images', [])
-                 if image_files:
-                     task_store[task_id]['msg'] = f'Uploading in progress {len(image_files)} 张图片到 Pixhost...'
-                     bbcode_lines = []
-                     for idx, img_p in enumerate(image_files):
-                         code = upload_to_pixhost(img_p)
-                         if code:
-                             bbcode_lines.append(code)
-                     task_store[task_id]['bbcode'] = "\n".join(bbcode_lines)
-
-                 task_store[task_id]['msg'] = '✅ All successful'
-            else: task_store[task_id]['msg'] = f"⚠️ Screenshot failed: {res}"
-        else: task_store[task_id]['msg'] = '✅ Completed (no video)'
+        work_dir = make_task_workspace(task_id)
+        item = prepare_seed_item(full_source_path, output_folder)
+        task_store[task_id]['files'] = item['files'] # Stages fill it in as results appear
+        seed_stage_torrent(task_id, item, tracker_url, is_private, comment, piece_size,
+                           should_cancel=lambda: task_store[task_id].get('cancel'))
+        seed_stage_media(task_id, item, shot_mode, shot_quality, work_dir, shot_seek, shot_sampling)
+        seed_stage_upload(task_id, item)
+        task_store[task_id].update({'bbcode': item['bbcode'], 'timings': item['timings'], 'upload_timings': item['upload_timings'], 'msg': item['note']})
         task_store[task_id]['status'] = 'done'
+    except TaskCancelled:
+        task_store[task_id]['status'] = 'error'
+        task_store[task_id]['msg'] = "Task cancelled"
     except Exception as e:
         task_store[task_id]['status'] = 'error'
         task_store[task_id]['msg'] = f"System error: {str(e)}"
+    finally:
+        if work_dir: shutil.rmtree(work_dir, ignore_errors=True)
 
-# === Subtitle Extraction Logic ===
-def extract_subtitle_streams(video_path):
-    try:
-        cmd_probe = ["ffprobe", "-v", "error", "-select_streams", "s", "-show_entries", "stream=index:stream_tags=language,title:stream=codec_name", "-of", "json", video_path]
-        result = subprocess.run(cmd_probe, capture_output=True, text=True)
-        try: data = json.loads(result.stdout)
-        except: return False, "Unable to read media information"
-        streams = data.get('streams', [])
-        if not streams: return False, "No subtitle stream detected"
-        count = 0
-        base_name = os.path.splitext(video_path)[0]
-        for stream in streams:
-            idx = stream.get('index'); codec = stream.get('codec_name', 'srt'); tags = stream.get('tags', {}); lang = tags.get('language', 'und')
-            ext = 'srt'
-            if 'ass' in codec: ext = 'ass'
-            elif 'pgs' in codec: ext = 'sup'
-            out_name = f"{base_name}.{lang}.{idx}.{ext}"
-            subprocess.run(["ffmpeg", "-y", "-i", video_path, "-map", f"0:{idx}", "-c", "copy", out_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            if os.path.exists(out_name): count += 1
-        return True, f"Extract {count} subtitles"
-    except Exception as e: return False, str(e)
-
-# === New: Audio track extraction logic ===
-def extract_audio_streams(video_path):
+def _batch_row(item):
+    return {k: item[k] for k in ('name', 'path', 'status', 'note', 'timings', 'upload_timings', 'files', 'bbcode')}
+
+def background_batch(task_id, paths, tracker_url, is_private, comment, piece_size, shot_mode, shot_quality, shot_seek=None, shot_sampling=None):
+    """
+    Seed many sources as a pipeline. Torrents are hashed one at a time on the hash pool
+    (sequential reads suit the disk best), while MediaInfo/screenshots and uploads of
+    items already hashed run on their own pools, so disk, CPU and network overlap.
+    """
+    task_store.setdefault(task_id, {}).update({'status': 'running', 'msg': 'Initialisation...', 'files': {}, 'bbcode': '', 'items': []})
+    log_task(task_id, f"Initiate batch seeding of {len(paths)} items...")
+    started = time.time()
+    should_cancel = lambda: task_store[task_id].get('cancel')
+    items = []
+    for i, path in enumerate(paths):
+        item = prepare_seed_item(path, default_output_folder(path), label=f"[{i + 1}/{len(paths)}] {os.path.basename(path.rstrip('/'))}: ")
+        item['index'] = i
+        items.append(item)
+
+    def publish():
+        task_store[task_id]['items'] = [_batch_row(item) for item in items]
+
+    def run_stage(previous, stage, fn, item, *args):
+        if previous is not None: previous.result() # Re-raises a failure of the item's earlier stage
+        if should_cancel(): raise TaskCancelled()
+        item['status'] = stage
+        publish()
+        return fn(task_id, item, *args)
+
+    def media(task_id, item):
+        work_dir = make_task_workspace(f"{task_id}_{item['index']}")
+        try: seed_stage_media(task_id, item, shot_mode, shot_quality, work_dir, shot_seek, shot_sampling)
+        finally: shutil.rmtree(work_dir, ignore_errors=True)
+
+    # Stage workers block on the previous stage's future; pools never wait on each other in a cycle
+    with ThreadPoolExecutor(1) as hash_pool, ThreadPoolExecutor(BATCH_MEDIA_WORKERS) as media_pool, \
+         ThreadPoolExecutor(BATCH_UPLOAD_WORKERS) as upload_pool:
+        final = []
+        for item in items:
+            hashed = hash_pool.submit(run_stage, None, 'hashing', seed_stage_torrent, item, tracker_url, is_private, comment, piece_size, should_cancel)
+            captured = media_pool.submit(run_stage, hashed, 'screenshots', media, item)
+            final.append(upload_pool.submit(run_stage, captured, 'uploading', seed_stage_upload, item))
+        for item, future in zip(items, final):
+            try:
+                future.result()
+                item['status'] = 'done'
+            except TaskCancelled:
+                item['status'] = 'cancelled'
+            except Exception as e:
+                item['status'], item['note'] = 'error', f"System error: {str(e)}"
+            t = item['timings']
+            log_task(task_id, f"{item['label']}{item['status']} (hash {t.get('hash', 0):.1f}s, media {t.get('media', 0):.1f}s, "
+                              f"upload {t.get('upload', 0):.1f}s) {item['note']}")
+            publish()
+
+    elapsed = time.time() - started
+    stage_total = sum(sum(item['timings'].values()) for item in items)
+    ok = [item for item in items if item['status'] == 'done']
+    bbcode = "\n\n".join(f"[b]{item['name']}[/b]\n{item['bbcode']}" for item in ok if item['bbcode'])
+    summary = {'items': len(items), 'done': len(ok), 'wall_seconds': round(elapsed, 2), 'stage_seconds': round(stage_total, 2)}
+    log_task(task_id, f"📦 Batch finished: {len(ok)}/{len(items)} succeeded in {elapsed:.1f}s "
+                      f"(stages took {stage_total:.1f}s in total, overlap saved {max(0.0, stage_total - elapsed):.1f}s)")
+    task_store[task_id].update({'bbcode': bbcode, 'batch_summary': summary})
+    if should_cancel(): task_store[task_id].update({'status': 'error', 'msg': 'Task cancelled'})
+    else: task_store[task_id].update({'status': 'done', 'msg': f"✅ Batch complete: {len(ok)}/{len(items)} succeeded"})
+
+# === Stream extraction: every selected subtitle/audio track in one ffmpeg pass ===
+SUBTITLE_EXTENSIONS = {'ass': 'ass', 'ssa': 'ass', 'hdmv_pgs_subtitle': 'sup', 'dvd_subtitle': 'mks', 'webvtt': 'vtt'}
+AUDIO_EXTENSIONS = {
+    'aac': 'm4a', 'ac3': 'ac3', 'eac3': 'eac3',
+    'dts': 'dts', 'truehd': 'thd', 'flac': 'flac',
+    'mp3': 'mp3', 'opus': 'opus', 'vorbis': 'ogg',
+    'pcm_s16le': 'wav', 'pcm_s24le': 'wav'
+}
+
+def select_streams(video_path, kinds, languages=None, codecs=None):
+    """
+    Streams of the given codec types, optionally narrowed to some languages / codecs,
+    each paired with its output file (Video name.Language.Stream index.Extension).
+    Returns None if the file cannot be probed.
+    """
+    languages = {l.strip().lower() for l in languages or [] if l.strip()}
+    codecs = {c.strip().lower() for c in codecs or [] if c.strip()}
+    base_name = os.path.splitext(video_path)[0]
+    selected = []
+    for kind in kinds:
+        streams = get_media_streams(video_path, kind)
+        if streams is None: return None
+        selected += [(kind, stream) for stream in streams]
+    result = []
+    for kind, stream in selected:
+        codec = stream.get('codec_name', 'unknown'); lang = stream.get('tags', {}).get('language', 'und')
+        if languages and lang.lower() not in languages: continue
+        if codecs and codec.lower() not in codecs: continue
+        # Unknown codecs: subtitles default to srt, audio to mka
+        ext = SUBTITLE_EXTENSIONS.get(codec, 'srt') if kind == 'subtitle' else AUDIO_EXTENSIONS.get(codec, 'mka')
+        result.append((stream, f"{base_name}.{lang}.{stream.get('index')}.{ext}"))
+    return result
+
+def _ffmpeg_copy(task_id, file_path, selected, duration, report_progress=True):
+    """One ffmpeg read of file_path stream-copying each (stream, out_name); returns (exit code, last errors)"""
+    cmd = ["ffmpeg", "-y", "-hide_banner", "-v", "error", "-nostats", "-progress", "pipe:1", "-i", file_path]
+    for stream, out_name in selected: cmd += ["-map", f"0:{stream.get('index')}", "-c", "copy", out_name]
+    errors = deque(maxlen=5)
+    last_logged = -10
+    metrics.inc('torrentmaker_subprocess_launches_total', program='ffmpeg')
+    proc = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True, errors='replace')
+    for line in proc.stdout:
+        key, sep, value = line.strip().partition('=')
+        if key == 'out_time_us' and value.isdigit() and duration and report_progress:
+            pct = min(100.0, int(value) / 1e6 / duration * 100)
+            task_store[task_id]['progress'] = round(pct, 1)
+            if pct - last_logged >= 10: # One log line per 10%, the msg follows every update
+                last_logged = pct
+                log_task(task_id, f"Progress: {pct:.0f}%")
+            else: task_store[task_id]['msg'] = f"Extracting... {pct:.1f}%"
+        elif not sep and line.strip(): errors.append(line.strip())
+        if task_store[task_id].get('cancel'):
+            proc.kill(); break
+    return proc.wait(), errors
+
+def _written(out_name): return os.path.exists(out_name) and os.path.getsize(out_name) > 0
+
+def extract_streams(task_id, file_path, kinds, languages=None, codecs=None):
+    """
+    Background job: demux the selected tracks in a single read of the source, reporting ffmpeg -progress.
+    If that pass fails or leaves a track unwritten, the tracks are retried one ffmpeg run each,
+    so one bad stream (e.g. a codec the target container rejects) doesn't cost the others.
+    """
+    label = ' + '.join('subtitles' if k == 'subtitle' else 'audio tracks' for k in kinds)
+    log_task(task_id, f"Extracting {label} from {os.path.basename(file_path)}")
     try:
-        # Use ffprobe to obtain audio stream information
-        cmd_probe = ["ffprobe", "-v", "error", "-select_streams", "a", "-show_entries", "stream=index:stream_tags=language,title:stream=codec_name", "-of", "json", video_path]
-        result = subprocess.run(cmd_probe, capture_output=True, text=True)
-        try: 
-            data = json.loads(result.stdout)
-        except: 
-            return False, "Unable to read media information"
-            
-        streams = data.get('streams', [])
-        if not streams: 
-            return False, "No audio stream detected"
-            
-        count = 0
-        base_name = os.path.splitext(video_path)[0]
-        
-        # 常见编码对应后缀映射
-        codec_map = {
-            'aac': 'm4a', 'ac3': 'ac3', 'eac3': 'eac3',
-            'dts': 'dts', 'truehd': 'thd', 'flac': 'flac',
-            'mp3': 'mp3', 'opus': 'opus', 'vorbis': 'ogg',
-            'pcm_s16le': 'wav', 'pcm_s24le': 'wav'
-        }
-
-        for stream in streams:
-            idx = stream.get('index')
-            codec = stream.get('codec_name', 'unknown')
-            tags = stream.get('tags', {})
-            lang = tags.get('language', 'und')
-            
-            # The suffix is determined by the encoding; the default for unknown encodings is mka.
-            ext = codec_map.get(codec, 'mka')
-            
-            # File name format: Video name.Language.Stream index.Extension
-            out_name = f"{base_name}.{lang}.{idx}.{ext}"
-            
-            # Extraction command (-c copy lossless extraction)
-            subprocess.run(["ffmpeg", "-y", "-i", video_path, "-map", f"0:{idx}", "-c", "copy", out_name], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-            
-            if os.path.exists(out_name): 
-                count += 1
-                
-        return True, f"成功提取 {count} 条音轨"
-    except Exception as e: 
-        return False, str(e)
+        selected = select_streams(file_path, kinds, languages, codecs)
+        if selected is None:
+            log_task(task_id, "❌ Unable to read media information")
+            task_store[task_id]['status'] = 'error'; return
+        if not selected:
+            log_task(task_id, f"❌ No matching {label} detected")
+            task_store[task_id]['status'] = 'error'; return
+        for stream, out_name in selected:
+            codec = stream.get('codec_name', '?'); lang = stream.get('tags', {}).get('language', 'und')
+            log_task(task_id, f"  #{stream.get('index')} {codec} [{lang}] -> {os.path.basename(out_name)}")
+
+        duration = get_video_duration(file_path)
+        code, errors = _ffmpeg_copy(task_id, file_path, selected, duration)
+        failed = {}
+        if not task_store[task_id].get('cancel'):
+            # A failed pass may have left truncated files behind, so every track is redone then
+            retry = selected if code != 0 else [pair for pair in selected if not _written(pair[1])]
+            if retry:
+                for err in errors: log_task(task_id, f"ffmpeg: {err}")
+                log_task(task_id, f"⚠️ Single-pass extraction incomplete (exit {code}), retrying {len(retry)} track(s) one by one")
+            for i, (stream, out_name) in enumerate(retry, 1):
+                if task_store[task_id].get('cancel'): break
+                task_store[task_id]['msg'] = f"Retrying track {i}/{len(retry)}..."
+                track_code, track_errors = _ffmpeg_copy(task_id, file_path, [(stream, out_name)], duration, report_progress=False)
+                if track_code != 0 or not _written(out_name):
+                    failed[out_name] = track_errors[-1] if track_errors else f"ffmpeg exited with {track_code}"
+                    if os.path.exists(out_name) and track_code != 0: os.remove(out_name)
+                    log_task(task_id, f"❌ #{stream.get('index')} -> {os.path.basename(out_name)}: {failed[out_name]}")
+            errors = [] if retry else errors
+
+        if task_store[task_id].get('cancel'):
+            log_task(task_id, "⛔ Extraction cancelled")
+            task_store[task_id].update({'status': 'error', 'msg': 'Task cancelled'}); return
+        written = [out for _, out in selected if out not in failed and _written(out)]
+        for err in errors: log_task(task_id, f"ffmpeg: {err}")
+        log_task(task_id, f"✅ Extracted {len(written)}/{len(selected)} {label}")
+        task_store[task_id].update({'progress': 100, 'failed_tracks': [os.path.basename(out) for out in failed]})
+        task_store[task_id]['status'] = 'done' if written else 'error'
+    except Exception as e:
+        log_task(task_id, f"💀 Fatal error: {str(e)}")
+        task_store[task_id]['status'] = 'error'
+
         
+# === Downloads: streamed screenshot archives and conditional/range file responses ===
+class _ChunkSink:
+    """Write-only, unseekable file object for zipfile; drain() hands over what was written so far"""
+    def __init__(self): self.chunks = []
+    def write(self, data):
+        self.chunks.append(bytes(data)); return len(data)
+    def flush(self): pass
+    def drain(self):
+        chunks, self.chunks = self.chunks, []
+        return chunks
+
+def screenshot_files(zip_path):
+    """Shot images behind a (virtual) <base>_Screenshots.zip, in frame order"""
+    if not zip_path.endswith(SHOTS_ZIP_SUFFIX): return []
+    base = zip_path[:-len(SHOTS_ZIP_SUFFIX)]
+    pattern = re.compile(re.escape(os.path.basename(base)) + r'_shot_(\d+)\.jpg$')
+    shots = []
+    for path in glob.glob(glob.escape(base) + "_shot_*.jpg"):
+        m = pattern.match(os.path.basename(path))
+        if m: shots.append((int(m.group(1)), path))
+    return [path for _, path in sorted(shots)]
+
+def stream_zip(paths, read_size=256 * 1024):
+    """
+    Yield a ZIP_STORED archive of `paths` chunk by chunk. JPEGs do not compress, so
+    nothing is deflated and no archive is written to disk; zipfile falls back to data
+    descriptors because the sink cannot seek.
+    """
+    sink = _ChunkSink()
+    with stage_span('zip'), zipfile.ZipFile(sink, 'w', zipfile.ZIP_STORED) as zf:
+        for path in paths:
+            info = zipfile.ZipInfo.from_file(path, os.path.basename(path))
+            with open(path, 'rb') as src, zf.open(info, 'w') as dst:
+                while True:
+                    chunk = src.read(read_size)
+                    if not chunk: break
+                    dst.write(chunk)
+                    yield from sink.drain()
+            yield from sink.drain()
+    yield from sink.drain() # Central directory
+
+def resolve_download_path(raw, decode=unquote):
+    """The path as given if it exists (names may contain '%20' literally), else its decoded form"""
+    if not raw: return None
+    if os.path.exists(raw): return raw
+    decoded = decode(raw)
+    return decoded if os.path.exists(decoded) else None
+
+def send_artifact(path, **kwargs):
+    """send_file with Range, ETag and If-Modified-Since handling spelled out, so resumes and revalidation work"""
+    response = send_file(path, conditional=True, etag=True, max_age=DOWNLOAD_MAX_AGE, **kwargs)
+    response.cache_control.public = False; response.cache_control.private = True # Behind the login
+    return response
+
+def send_screenshot_zip(zip_path, shots):
+    stats = [os.stat(p) for p in shots]
+    etag = hashlib.sha1(json.dumps([[os.path.basename(p), st.st_size, st.st_mtime_ns] for p, st in zip(shots, stats)]).encode()).hexdigest()
+    name = os.path.basename(zip_path)
+    response = Response(stream_with_context(stream_zip(shots)), mimetype='application/zip', headers={
+        'Content-Disposition': f"attachment; filename*=UTF-8''{quote(name)}",
+        'Accept-Ranges': 'none', # Streamed, so no byte offsets to resume from; ETag still allows revalidation
+    })
+    response.set_etag(etag)
+    response.last_modified = datetime.datetime.fromtimestamp(max(st.st_mtime for st in stats), datetime.timezone.utc)
+    response.cache_control.max_age = DOWNLOAD_MAX_AGE; response.cache_control.private = True
+    return response.make_conditional(request)
+
+# ================= Media Index =================
+class MediaIndex:
+    """
+    On-disk index of every visible file under `root` (size, mtime, video flag, probed
+    duration) plus per-directory recursive totals and the largest media file of each
+    subtree, so those become single-row lookups. A crawler thread keeps it fresh: with
+    inotify_simple installed, changed directories are relisted as events arrive;
+    otherwise every pass relists only directories whose mtime changed. A forced full pass
+    every INDEX_FULL_EVERY passes picks up files rewritten in place.
+    """
+    def __init__(self, db_path, root):
+        self.db_path, self.root = db_path, root
+        self.conn = None
+        self.lock = threading.RLock()
+        self.started = False
+        self.inotify = None
+        self.watches = {} # inotify watch descriptor -> relative directory
+        self.watched = set() # The same directories, for the crawler's per-directory membership test
+
+    def _db(self):
+        if self.conn is None:
+            conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL") # Every worker reads it while the leader's crawler writes
+            conn.executescript("""
+                CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, parent TEXT NOT NULL, size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL, is_video INTEGER NOT NULL, duration REAL);
+                CREATE INDEX IF NOT EXISTS files_parent ON files(parent);
+                CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, parent TEXT, mtime_ns INTEGER,
+                    total_size INTEGER DEFAULT 0, file_count INTEGER DEFAULT 0, largest_media TEXT, largest_size INTEGER DEFAULT 0);
+                CREATE INDEX IF NOT EXISTS dirs_parent ON dirs(parent);""")
+            self.conn = conn
+        return self.conn
+
+    def rel(self, full_path):
+        """Index key of an absolute path ('' for the root), or None if it lies outside the root"""
+        rel = os.path.relpath(os.path.abspath(full_path), os.path.abspath(self.root))
+        if rel == '.': return ''
+        return None if rel.startswith('..') else rel.replace(os.sep, '/')
+
+    @staticmethod
+    def _parent(rel):
+        return rel.rpartition('/')[0] if rel else None
+
+    def _ancestors(self, rel):
+        while rel is not None:
+            yield rel
+            rel = self._parent(rel)
+
+    @staticmethod
+    def _is_media(rel):
+        return 'torrent' not in rel.split('/')[:-1]
+
+    def _largest_under(self, db, rel):
+        """(path, size) of the largest media file in a subtree; GLOB, unlike LIKE, is case-sensitive like _is_media"""
+        return tuple(db.execute("""SELECT path, size FROM files WHERE (? = '' OR path >= ? AND path < ?) AND size > 0
+                                   AND ('/' || path) NOT GLOB '*/torrent/*' ORDER BY size DESC LIMIT 1""",
+                                (rel, rel + '/', rel + '0')).fetchone() or (None, 0))
+
+    def _update_totals(self, db, rel, size, count, grown=(), lost=()):
+        """
+        Carry a change in directory `rel` up to the root: size and file count deltas, media files
+        that appeared or grew (`grown`, (path, size) pairs), and files or subtrees that vanished or
+        shrank (`lost`). Only an ancestor whose largest file is lost re-queries its subtree.
+        """
+        for d in self._ancestors(rel):
+            row = db.execute("SELECT largest_media, largest_size FROM dirs WHERE path = ?", (d,)).fetchone()
+            if row is None: continue
+            largest = tuple(row)
+            if largest[0] and any(largest[0] == p or largest[0].startswith(p + '/') for p in lost): largest = self._largest_under(db, d)
+            for p, file_size in grown:
+                if file_size > largest[1]: largest = (p, file_size)
+            db.execute("UPDATE dirs SET total_size = total_size + ?, file_count = file_count + ?, largest_media = ?, largest_size = ? WHERE path = ?",
+                       (size, count, *largest, d))
+
+    def _forget_dir(self, rel):
+        # Range bounds instead of LIKE: names may contain % or _, and '0' sorts right after '/'
+        db = self._db()
+        row = db.execute("SELECT total_size, file_count FROM dirs WHERE path = ?", (rel,)).fetchone()
+        for table in ('files', 'dirs'):
+            db.execute(f"DELETE FROM {table} WHERE path = ? OR (path >= ? AND path < ?)", (rel, rel + '/', rel + '0'))
+        if row and rel: self._update_totals(db, self._parent(rel), -row[0], -row[1], lost=[rel])
+
+    def refresh_dir(self, rel, force=False):
+        """Relist one directory if its mtime changed (or `force`); returns (anything changed, subdirectories)"""
+        full = os.path.join(self.root, rel)
+        try: st = os.stat(full)
+        except OSError:
+            with self.lock:
+                self._forget_dir(rel); self._db().commit()
+            return True, []
+        with self.lock:
+            db = self._db()
+            row = db.execute("SELECT mtime_ns FROM dirs WHERE path = ?", (rel,)).fetchone()
+            if row and row[0] == st.st_mtime_ns and not force:
+                return False, [r[0] for r in db.execute("SELECT path FROM dirs WHERE parent = ?", (rel,))]
+        files, subdirs = {}, []
+        try:
+            with os.scandir(full) as it:
+                for entry in it:
+                    if entry.name.startswith('.'): continue
+                    child = f"{rel}/{entry.name}" if rel else entry.name
+                    try:
+                        if entry.is_dir(follow_symlinks=False): # Symlinked dirs are not followed (loops)
+                            subdirs.append(child); continue
+                        s = entry.stat()
+                    except OSError: continue
+                    files[child] = (s.st_size, s.st_mtime_ns)
+        except OSError: return False, []
+        with self.lock:
+            db = self._db()
+            known = {p: (size, m) for p, size, m in db.execute("SELECT path, size, mtime_ns FROM files WHERE parent = ?", (rel,))}
+            changed = [(p, rel, size, m, int(p.lower().endswith(VIDEO_EXTENSIONS)))
+                       for p, (size, m) in files.items() if known.get(p) != (size, m)]
+            gone = [(p,) for p in known if p not in files]
+            old_subdirs = {r[0] for r in db.execute("SELECT path FROM dirs WHERE parent = ?", (rel,))}
+            db.executemany("INSERT OR REPLACE INTO files (path, parent, size, mtime_ns, is_video, duration) VALUES (?, ?, ?, ?, ?, NULL)", changed)
+            db.executemany("DELETE FROM files WHERE path = ?", gone)
+            for removed in old_subdirs - set(subdirs): self._forget_dir(removed)
+            # Rows without an mtime until crawled, so subtree_current() sees subdirectories not listed yet
+            db.executemany("INSERT OR IGNORE INTO dirs (path, parent) VALUES (?, ?)", [(sub, rel) for sub in subdirs])
+            db.execute("INSERT OR IGNORE INTO dirs (path, parent) VALUES (?, ?)", (rel, self._parent(rel)))
+            if changed or gone:
+                old = {p: known[p][0] for p, *_ in changed if p in known}
+                self._update_totals(db, rel, sum(c[2] for c in changed) - sum(old.values()) - sum(known[p][0] for p, in gone),
+                                    len(changed) - len(old) - len(gone),
+                                    grown=[(p, size) for p, _, size, *_ in changed if self._is_media(p) and size > old.get(p, 0)],
+                                    lost=[p for p, in gone] + [p for p, _, size, *_ in changed if size < old.get(p, 0)])
+            db.execute("UPDATE dirs SET mtime_ns = ? WHERE path = ?", (st.st_mtime_ns, rel))
+            db.commit()
+        return bool(changed or gone or old_subdirs != set(subdirs)), subdirs
+
+    def crawl(self, start='', force=False):
+        """Walk the subtree at `start`, relisting changed directories; returns whether anything changed"""
+        changed, stack = False, [start]
+        while stack:
+            rel = stack.pop()
+            dir_changed, subdirs = self.refresh_dir(rel, force)
+            changed |= dir_changed
+            if self.inotify is not None and rel not in self.watched: self._watch(rel)
+            stack.extend(subdirs)
+        return changed
+
+    def rebuild_totals(self):
+        """
+        Recursive size, file count and largest media file (outside torrent/ folders) for every
+        directory, from scratch. refresh_dir keeps them current incrementally; this only
+        reconciles an index written by an older version, once per crawler start.
+        """
+        with self.lock:
+            db = self._db()
+            totals = {}
+            for path, parent, size in db.execute("SELECT path, parent, size FROM files"):
+                media = self._is_media(path)
+                d = parent
+                while d is not None:
+                    t = totals.setdefault(d, [0, 0, None, 0])
+                    t[0] += size; t[1] += 1
+                    if media and size > t[3]: t[2], t[3] = path, size
+                    d = self._parent(d)
+            db.execute("UPDATE dirs SET total_size = 0, file_count = 0, largest_media = NULL, largest_size = 0")
+            db.executemany("UPDATE dirs SET total_size = ?, file_count = ?, largest_media = ?, largest_size = ? WHERE path = ?",
+                           [(*t, d) for d, t in totals.items()])
+            db.commit()
+
+    def fill_durations(self, limit):
+        """Probe a few not-yet-probed videos per pass (results also land in the probe cache)"""
+        with self.lock:
+            pending = [r[0] for r in self._db().execute(
+                "SELECT path FROM files WHERE is_video = 1 AND duration IS NULL AND size > 0 LIMIT ?", (limit,))]
+        for rel in pending:
+            duration = get_video_duration(os.path.join(self.root, rel))
+            with self.lock:
+                self._db().execute("UPDATE files SET duration = ? WHERE path = ?", (duration, rel))
+                self._db().commit()
+
+    def dir_summary(self, full_path):
+        rel = self.rel(full_path)
+        if rel is None: return None
+        with self.lock:
+            row = self._db().execute("SELECT mtime_ns, total_size, file_count, largest_media, largest_size FROM dirs WHERE path = ?", (rel,)).fetchone()
+        if not row: return None
+        return dict(zip(('mtime_ns', 'total_size', 'file_count', 'largest_media', 'largest_size'), row))
+
+    def subtree_current(self, full_path):
+        """
+        True when every directory under full_path is indexed with its current mtime, i.e. no entry
+        was added, removed or renamed anywhere in the subtree since it was last listed. One stat
+        per directory; files rewritten in place are the crawler's (inotify / full pass) job.
+        """
+        rel = self.rel(full_path)
+        if rel is None: return False
+        with self.lock:
+            rows = self._db().execute("SELECT path, mtime_ns FROM dirs WHERE ? = '' OR path = ? OR (path >= ? AND path < ?)",
+                                      (rel, rel, rel + '/', rel + '0')).fetchall()
+        if not rows: return False
+        for path, mtime_ns in rows:
+            try:
+                if os.stat(os.path.join(self.root, path)).st_mtime_ns != mtime_ns: return False
+            except OSError: return False
+        return True
+
+    def child_dir_sizes(self, full_path):
+        """{name: recursive size} for the indexed subdirectories of a directory"""
+        rel = self.rel(full_path)
+        if rel is None: return {}
+        with self.lock:
+            rows = self._db().execute("SELECT path, total_size FROM dirs WHERE parent = ?", (rel,)).fetchall()
+        return {path.rpartition('/')[2]: size for path, size in rows}
+
+    def _watch(self, rel):
+        try:
+            wd = self.inotify.add_watch(os.path.join(self.root, rel), INDEX_INOTIFY_MASK)
+            self.watches[wd] = rel; self.watched.add(rel)
+        except OSError as e: # Usually fs.inotify.max_user_watches; fall back to mtime diffing
+            print(f"Media index: inotify unavailable ({e}), polling instead", flush=True)
+            self.inotify.close(); self.inotify = None; self.watches, self.watched = {}, set()
+
+    def _wait_for_changes(self, timeout):
+        """Apply inotify events until `timeout` seconds have passed"""
+        deadline = time.time() + timeout
+        while self.inotify is not None and time.time() < deadline:
+            events = self.inotify.read(timeout=int((deadline - time.time()) * 1000), read_delay=500)
+            for e in events:
+                if e.mask & inotify_flags.IGNORED: # Directory deleted or moved away: its watch is gone, re-watch if it returns
+                    self.watched.discard(self.watches.pop(e.wd, None))
+            dirty = {self.watches.get(e.wd) for e in events if not e.name.startswith('.')} - {None}
+            for rel in dirty:
+                _, subdirs = self.refresh_dir(rel, force=True)
+                for sub in subdirs: self.crawl(sub)
+
+    def start(self):
+        """Launch the crawler thread (idempotent)"""
+        with self.lock:
+            if self.started: return
+            self.started = True
+        threading.Thread(target=self._crawl_loop, daemon=True).start()
+
+    def _crawl_loop(self):
+        if INotify is not None:
+            try: self.inotify = INotify()
+            except OSError: self.inotify = None
+        passes = 0
+        try: self.rebuild_totals()
+        except Exception as e: print(f"Media index totals failed: {e}", flush=True)
+        while True:
+            try:
+                self.crawl(force=passes % INDEX_FULL_EVERY == 0)
+                self.fill_durations(INDEX_PROBE_BATCH)
+            except Exception as e: print(f"Media index pass failed: {e}", flush=True)
+            passes += 1
+            if self.inotify is None: time.sleep(INDEX_INTERVAL); continue
+            # Events keep the index current; the periodic crawl is only a safety net
+            try: self._wait_for_changes(INDEX_INTERVAL * 10)
+            except Exception as e: print(f"Media index watch failed: {e}", flush=True)
+
+media_index = MediaIndex(MEDIA_INDEX_DB, BASE_DIR)
+
+# ================= Directory Listing =================
+_listing_cache = OrderedDict() # full_path -> (dir mtime_ns, scanned_at, entries, {(sort, desc): sorted entries})
+_listing_lock = threading.Lock()
+
+def scan_directory(full_path):
+    """
+    Visible entries of a directory from a single os.scandir pass, one stat per entry.
+    Cached briefly per directory and rescanned as soon as the directory's mtime changes
+    (entries added, removed or renamed); the TTL bounds staleness of sizes of files
+    written in place.
+    """
+    version = os.stat(full_path).st_mtime_ns
+    now = time.time()
+    with _listing_lock:
+        hit = _listing_cache.get(full_path)
+        if hit and hit[0] == version and now - hit[1] < LIST_CACHE_TTL:
+            _listing_cache.move_to_end(full_path)
+            return hit
+    entries = []
+    dir_sizes = media_index.child_dir_sizes(full_path) # Recursive folder sizes, 0 until first indexed
+    with os.scandir(full_path) as it:
+        for entry in it:
+            if entry.name.startswith('.'): continue
+            try: st = entry.stat()
+            except OSError: st = entry.stat(follow_symlinks=False) # Dangling symlink
+            is_dir = stat.S_ISDIR(st.st_mode)
+            entries.append({
+                'name': entry.name,
+                'type': 'dir' if is_dir else 'file',
+                'size': dir_sizes.get(entry.name, 0) if is_dir else st.st_size,
+                'mtime': int(st.st_mtime),
+                'is_txt': entry.name.lower().endswith(('.txt', '.nfo', '.md')),
+            })
+    hit = (version, now, entries, {})
+    with _listing_lock:
+        _listing_cache[full_path] = hit
+        while len(_listing_cache) > LIST_CACHE_DIRS: _listing_cache.popitem(last=False)
+    return hit
+
+def drop_listing_cache(full_path):
+    with _listing_lock: _listing_cache.pop(full_path, None)
+
+def sorted_listing(listing, sort, desc):
+    """Directories first, then by `sort` ('name', 'size' or 'mtime'); memoised on the cached listing"""
+    views = listing[3]
+    if (sort, desc) not in views:
+        key = (lambda e: e['name'].lower()) if sort == 'name' else (lambda e: (e[sort], e['name'].lower()))
+        rows = sorted(listing[2], key=key, reverse=desc)
+        views[(sort, desc)] = [e for e in rows if e['type'] == 'dir'] + [e for e in rows if e['type'] != 'dir']
+    return views[(sort, desc)]
+
+# ================= Job Scheduler =================
+class JobScheduler:
+    """
+    Persistent job queue. Jobs live in SQLite so queued and interrupted work survives a
+    restart; a dispatcher thread starts the highest-priority queued job whose resource
+    class still has a free slot. Any worker process may submit or cancel; only the leader
+    process calls start() and runs jobs.
+
+    Slots are held per stage, not per job: a job is admitted with a slot of its kind's
+    class, and multi-stage jobs run each stage under `slot()`, so a seed job gives its io
+    slot back after hashing and takes a cpu slot for screenshots and a net one for uploads.
+    """
+    def __init__(self, db_path, limits):
+        self.db_path = db_path
+        self.limits = limits
+        self.running = {name: 0 for name in limits} # Slots in use per class
+        self.admitted = {} # task_id -> class of the admission slot the job has not used or released yet
+        self.cond = threading.Condition()
+        self.conn = None
+        self.started = False
+
+    def _db(self):
+        if self.conn is None:
+            self.conn = sqlite3.connect(self.db_path, timeout=30, check_same_thread=False)
+            self.conn.row_factory = sqlite3.Row
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, kind TEXT NOT NULL, resource TEXT NOT NULL, priority INTEGER NOT NULL,
+                status TEXT NOT NULL, payload TEXT NOT NULL, created REAL, started REAL, finished REAL)""")
+            try: self.conn.execute("ALTER TABLE jobs ADD COLUMN cancel_requested INTEGER NOT NULL DEFAULT 0")
+            except sqlite3.OperationalError: pass # Already there
+        return self.conn
+
+    def start(self):
+        """Requeue jobs interrupted by a restart and launch the dispatcher (idempotent)"""
+        with self.cond:
+            if self.started: return
+            self.started = True
+            db = self._db()
+            interrupted = db.execute("SELECT id, kind FROM jobs WHERE status = 'running'").fetchall()
+            db.execute("UPDATE jobs SET status = 'queued', started = NULL WHERE status = 'running'")
+            db.execute(f"UPDATE jobs SET {JOB_SCRUB} WHERE status NOT IN ('queued', 'running')") # Rows finished by older versions
+            db.commit()
+        for row in interrupted: task_store.put(row['id'], self._initial_state(row['kind'], 'Queued (restored after restart)...'))
+        threading.Thread(target=self._dispatch_loop, daemon=True).start()
+
+    @staticmethod
+    def _initial_state(kind, msg):
+        return {'status': 'queued', 'msg': msg, 'files': {}, 'bbcode': '', 'type': kind}
+
+    @staticmethod
+    def _secrets_path(task_id):
+        return os.path.join(JOB_SECRETS_DIR, f"{os.path.basename(task_id)}.json")
+
+    def _put_secrets(self, task_id, secrets):
+        os.makedirs(JOB_SECRETS_DIR, mode=0o700, exist_ok=True)
+        with os.fdopen(os.open(self._secrets_path(task_id), os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), 'w') as f: json.dump(secrets, f)
+
+    def _secrets(self, task_id):
+        """A job's secrets; {} once dropped, or lost with the temp dir (the job then falls back to the configured key)"""
+        try:
+            with open(self._secrets_path(task_id)) as f: return json.load(f)
+        except (OSError, ValueError): return {}
+
+    def _drop_secrets(self, task_id):
+        try: os.remove(self._secrets_path(task_id))
+        except OSError: pass
+
+    def submit(self, kind, payload, task_id=None):
+        resource, priority = JOB_KINDS[kind]
+        task_id = task_id or str(uuid.uuid4())[:8]
+        payload = dict(payload)
+        secrets = {k: payload.pop(k) for k in JOB_SECRET_FIELDS if payload.get(k)}
+        if secrets: self._put_secrets(task_id, secrets)
+        task_store.put(task_id, self._initial_state(kind, 'Queued...'))
+        with self.cond:
+            db = self._db()
+            db.execute("INSERT INTO jobs (id, kind, resource, priority, status, payload, created) VALUES (?, ?, ?, ?, 'queued', ?, ?)",
+                       (task_id, kind, resource, priority, json.dumps(payload), time.time()))
+            db.commit()
+            self.cond.notify_all()
+        return task_id
+
+    def cancel(self, task_id):
+        """Drop a queued job, or flag a running one so its stages stop at the next check"""
+        with self.cond:
+            db = self._db()
+            cur = db.execute(f"UPDATE jobs SET status = 'cancelled', finished = ?, {JOB_SCRUB} WHERE id = ? AND status = 'queued'", (time.time(), task_id))
+            dropped = cur.rowcount > 0
+            # The leader's dispatcher hands the flag to the running job, whichever worker received the request
+            flagged = db.execute("UPDATE jobs SET cancel_requested = 1 WHERE id = ? AND status = 'running'", (task_id,)).rowcount > 0
+            db.commit()
+        if task_id in task_store: task_store[task_id]['cancel'] = True
+        if dropped:
+            self._drop_secrets(task_id)
+            task_store.patch(task_id, status='error', msg='Task cancelled')
+        return dropped or flagged or task_id in task_store
+
+    def depth(self):
+        with self.cond:
+            rows = self._db().execute("SELECT resource, status, COUNT(*) AS n FROM jobs WHERE status IN ('queued', 'running') GROUP BY resource, status").fetchall()
+            classes = {name: {'limit': limit, 'running': 0, 'queued': 0} for name, limit in self.limits.items()}
+            for row in rows:
+                if row['resource'] in classes: classes[row['resource']][row['status']] = row['n']
+            jobs = [dict(row) for row in self._db().execute(
+                "SELECT id, kind, resource, priority, status, created, started FROM jobs WHERE status IN ('queued', 'running') ORDER BY priority DESC, created")]
+        return {'resources': classes, 'jobs': jobs}
+
+    def _dispatch_loop(self):
+        while True:
+            with self.cond:
+                db = self._db()
+                for row in db.execute("SELECT * FROM jobs WHERE status = 'queued' ORDER BY priority DESC, created").fetchall():
+                    if self.running.get(row['resource'], 0) >= self.limits.get(row['resource'], 1): continue
+                    self.running[row['resource']] += 1
+                    self.admitted[row['id']] = row['resource']
+                    db.execute("UPDATE jobs SET status = 'running', started = ? WHERE id = ?", (time.time(), row['id']))
+                    db.commit()
+                    threading.Thread(target=self._run, args=(dict(row),), daemon=True).start()
+                for row in db.execute("SELECT id FROM jobs WHERE status = 'running' AND cancel_requested = 1").fetchall():
+                    if row['id'] in task_store: task_store[row['id']]['cancel'] = True
+                # Jobs submitted by other workers only show up in the table, so poll as well as wait
+                self.cond.wait(timeout=JOB_POLL_INTERVAL)
+
+    @contextmanager
+    def slot(self, task_id, resource):
+        """Hold a `resource` slot for one stage of a running job, waiting for one if the class is full (TaskCancelled if cancelled meanwhile)"""
+        with self.cond:
+            admitted = self.admitted.pop(task_id, None)
+            if admitted != resource:
+                if admitted is not None: # Hand the admission slot back before waiting on another class
+                    self.running[admitted] -= 1
+                    self.cond.notify_all()
+                while self.running[resource] >= self.limits[resource]:
+                    # The dispatcher hands cancel flags over without notifying, hence the timeout
+                    if task_store.get(task_id, {}).get('cancel'): raise TaskCancelled()
+                    self.cond.wait(timeout=JOB_POLL_INTERVAL)
+                self.running[resource] += 1
+        try: yield
+        finally:
+            with self.cond:
+                self.running[resource] -= 1
+                self.cond.notify_all()
+
+    def _run(self, job):
+        task_id = job['id']
+        if task_id not in task_store: task_store[task_id] = self._initial_state(job['kind'], 'Starting...')
+        task_store[task_id]['status'] = 'running'
+        try:
+            JOB_HANDLERS[job['kind']](task_id, **json.loads(job['payload']), **self._secrets(task_id))
+        except Exception as e:
+            task_store[task_id].update({'status': 'error', 'msg': f"System error: {str(e)}"})
+        finally:
+            status = task_store.get(task_id, {}).get('status')
+            self._drop_secrets(task_id)
+            task_store.notify() # Push the final state to event streams right away
+            with self.cond:
+                if self.admitted.pop(task_id, None): self.running[job['resource']] -= 1
+                db = self._db()
+                db.execute(f"UPDATE jobs SET status = ?, finished = ?, {JOB_SCRUB} WHERE id = ?",
+                           ('done' if status == 'done' else 'error', time.time(), task_id))
+                # Keep a week of history
+                db.execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?", (time.time() - 7 * 86400,))
+                db.commit()
+                self.cond.notify_all()
+
+JOB_HANDLERS = {
+    'seed': lambda task_id, **kw: background_process(task_id=task_id, **kw),
+    'batch': lambda task_id, **kw: background_batch(task_id, **kw),
+    'extract': lambda task_id, **kw: extract_streams(task_id, **kw),
+    'translate': lambda task_id, file_path, api_key=None: background_translate(task_id, file_path, api_key),
+}
+scheduler = JobScheduler(JOBS_DB, RESOURCE_LIMITS)
+
+def _queue_gauge():
+    resources = scheduler.depth()['resources']
+    return [({'resource': name, 'state': state}, info[state]) for name, info in resources.items() for state in ('queued', 'running')]
+
+def _tasks_gauge():
+    return [({'status': status}, count) for status, count in sorted(Counter(task_store.statuses().values()).items())]
+
+metrics.gauge('torrentmaker_queue_jobs', _queue_gauge)
+metrics.gauge('torrentmaker_tasks', _tasks_gauge)
+
+# ================= Worker coordination =================
+# Under gunicorn every worker process serves requests, but only the holder of LEADER_LOCK runs the
+# job dispatcher, the media crawler and the task-state publisher. The lock dies with its process,
+# and a waiting worker takes over.
+_leader = {'fd': None, 'started': False}
+
+def is_leader():
+    return _leader['fd'] is not None
+
+def _try_lead():
+    fd = os.open(LEADER_LOCK, os.O_RDWR | os.O_CREAT, 0o644)
+    try: fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        os.close(fd)
+        return False
+    os.ftruncate(fd, 0); os.write(fd, str(os.getpid()).encode())
+    _leader['fd'] = fd
+    return True
+
+def _sync_loop():
+    """Leader: publish task states for the other workers, plus a metrics snapshot for their /metrics"""
+    for rounds in itertools.count():
+        try:
+            task_store.publish()
+            if rounds % METRICS_PUBLISH_EVERY == 0: task_store.put_shared('metrics', metrics.render())
+        except Exception as e: print(f"Task state sync failed: {e}", flush=True)
+        time.sleep(TASK_SYNC_INTERVAL)
+
+def start_background_services():
+    """Once per process (dev server, or each gunicorn worker): compete for leadership in the background"""
+    if _leader['started']: return
+    _leader['started'] = True
+    def run():
+        while not _try_lead(): time.sleep(LEADER_RETRY)
+        print(f"Worker {os.getpid()} is the leader: running jobs and the media index", flush=True)
+        scheduler.start() # Resume jobs left queued or running by the previous leader
+        media_index.start()
+        _sync_loop()
+    threading.Thread(target=run, daemon=True).start()
+
 # ================= Routing =================
 def login_required(f):
     @wraps(f)
@@ -474,12 +2472,72 @@ def logout():
     session.pop('logged_in', None)
     return redirect(url_for('login'))
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Prometheus text format; needs a login session or `Authorization: Bearer $METRICS_TOKEN`"""
+    token = request.headers.get('Authorization', '')
+    if 'logged_in' not in session and not (METRICS_TOKEN and token == f"Bearer {METRICS_TOKEN}"):
+        return Response("Unauthorized\n", status=401, mimetype='text/plain')
+    # Jobs run in the leader, so other workers serve its latest snapshot
+    text = metrics.render() if is_leader() else (task_store.get_shared('metrics') or metrics.render())
+    return Response(text, mimetype='text/plain; version=0.0.4')
+
 @app.route('/api/status')
 @login_required
 def check_status():
     task_id = request.args.get('task_id')
-    if task_id and task_id in task_store: return jsonify(task_store[task_id])
-    return jsonify({'status': 'unknown'})
+    view = task_store.view(task_id, request.args.get('since', type=int)) if task_id else None
+    if view is None: return jsonify({'status': 'unknown'})
+    return jsonify(view)
+
+@app.route('/api/events')
+@login_required
+def task_events():
+    """
+    Server-Sent Events until the task finishes: the first update carries the whole state, later
+    ones only the fields that changed (removed ones as null) and the new log lines
+    """
+    task_id = request.args.get('task_id')
+    # EventSource sends Last-Event-ID on reconnect, so the stream resumes after the last line seen
+    since = request.headers.get('Last-Event-ID', type=int) or request.args.get('since', 0, type=int)
+
+    def stream():
+        cursor, sent, quiet_since = since, {}, time.time() # sent: field -> JSON last sent
+        yield "retry: 3000\n\n"
+        while True:
+            mark = task_store.mark(task_id)
+            view = task_store.view(task_id, cursor)
+            if view is None:
+                yield "event: gone\ndata: {}\n\n"
+                return
+            fields = {k: json.dumps(v, sort_keys=True, ensure_ascii=False) for k, v in view.items() if k not in ('logs', 'log_seq', 'logs_truncated')}
+            delta = {k: fields.get(k, 'null') for k in fields.keys() | sent.keys() if fields.get(k) != sent.get(k)}
+            if view['logs']: delta.update(logs=json.dumps(view['logs'], ensure_ascii=False), logs_truncated=json.dumps(view['logs_truncated']))
+            if delta:
+                sent, cursor, quiet_since = fields, view['log_seq'], time.time()
+                data = "{" + ", ".join(f"{json.dumps(k)}: {v}" for k, v in delta.items()) + "}"
+                yield f"id: {cursor}\nevent: update\ndata: {data}\n\n"
+            if view['status'] in ('done', 'error'): return
+            if time.time() - quiet_since >= SSE_KEEPALIVE:
+                quiet_since = time.time()
+                yield ": keepalive\n\n"
+            # Woken by log lines and by the leader's publish of any other change; idle streams sleep until the keepalive
+            task_store.wait(task_id, mark, timeout=max(0.0, quiet_since + SSE_KEEPALIVE - time.time()))
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/cancel_task', methods=['POST'])
+@login_required
+def cancel_task():
+    task_id = (request.json or {}).get('task_id')
+    if not scheduler.cancel(task_id): return jsonify({'success': False, 'msg': 'Unknown task'})
+    return jsonify({'success': True})
+
+@app.route('/api/queue')
+@login_required
+def queue_status():
+    return jsonify({'success': True, **scheduler.depth()})
 
 @app.route('/api/list_files', methods=['POST'])
 @login_required
@@ -493,19 +2551,24 @@ def list_files():
         if current_rel == '.': current_rel = ""
         if os.path.isfile(full_path):
             file_list.append({'name': os.path.basename(full_path), 'type': 'file', 'size': os.path.getsize(full_path), 'is_txt': full_path.endswith('.txt')})
-        else:
-            for item in sorted(os.listdir(full_path)):
-                if item.startswith('.'): continue
-                item_path = os.path.join(full_path, item)
-                is_dir = os.path.isdir(item_path)
-                file_list.append({
-                    'name': item,
-                    'type': 'dir' if is_dir else 'file',
-                    'size': os.path.getsize(item_path) if not is_dir else 0,
-                    'is_txt': item.lower().endswith(('.txt', '.nfo', '.md'))
-                })
-        file_list.sort(key=lambda x: (x['type'] != 'dir', x['name']))
-        return jsonify({'success': True, 'files': file_list, 'current_path': current_rel})
+            return jsonify({'success': True, 'files': file_list, 'current_path': current_rel, 'total': 1, 'next_cursor': None})
+
+        sort = request.json.get('sort', 'name')
+        if sort not in ('name', 'size', 'mtime'): sort = 'name'
+        desc = request.json.get('order') == 'desc'
+        needle = (request.json.get('filter') or '').strip().lower()
+        limit = max(1, min(int(request.json.get('limit') or LIST_PAGE_SIZE), 5000))
+        listing = scan_directory(full_path)
+        rows = sorted_listing(listing, sort, desc)
+        if needle: rows = [e for e in rows if needle in e['name'].lower()]
+        # Cursor is "offset:dir version"; a changed version means the client should reload from the top
+        cursor = request.json.get('cursor') or ''
+        offset, _, version = cursor.partition(':')
+        offset = int(offset) if offset.isdigit() else 0
+        page = rows[offset:offset + limit]
+        next_cursor = f"{offset + limit}:{listing[0]}" if offset + limit < len(rows) else None
+        return jsonify({'success': True, 'files': page, 'current_path': current_rel, 'total': len(rows),
+                        'next_cursor': next_cursor, 'stale': bool(version) and version != str(listing[0])})
     except Exception as e: return jsonify({'success': False, 'msg': str(e)})
 
 @app.route('/api/file_op', methods=['POST'])
@@ -516,10 +2579,8 @@ def file_op():
         op_type = data.get('type')
         current_path = data.get('current_path', '')
         
-        user_key = data.get('api_key') 
-        if user_key: 
-            global DEEPSEEK_API_KEY
-            DEEPSEEK_API_KEY = user_key
+        # A key typed into the page travels with the job: the worker that runs it may be another process
+        user_key = data.get('api_key')
 
         if op_type == 'delete':
             target = data.get('filename')
@@ -555,19 +2616,20 @@ def file_op():
             filename = data.get('filename'); content = data.get('content')
             full_target = get_safe_path(os.path.join(current_path, filename))
             with open(full_target, 'w', encoding='utf-8') as f: f.write(content)
+            drop_listing_cache(os.path.dirname(full_target)) # Size changed, directory mtime did not
             return jsonify({'success': True})
 
-        elif op_type == 'extract_subs':
+        elif op_type in ('extract_subs', 'extract_audio'):
             filename = data.get('filename')
             full_target = get_safe_path(os.path.join(current_path, filename))
-            success, msg = extract_subtitle_streams(full_target)
-            return jsonify({'success': success, 'msg': msg})
-
-        elif op_type == 'extract_audio':
-            filename = data.get('filename')
-            full_target = get_safe_path(os.path.join(current_path, filename))
-            success, msg = extract_audio_streams(full_target)
-            return jsonify({'success': success, 'msg': msg})
+            if not os.path.exists(full_target): return jsonify({'success': False, 'msg': 'The file does not exist.'})
+            # Optional filters, e.g. "eng,chi" / "hdmv_pgs_subtitle"
+            split = lambda v: [x for x in (v.split(',') if isinstance(v, str) else v or []) if x.strip()]
+            task_id = scheduler.submit('extract', {
+                'file_path': full_target, 'kinds': ['subtitle'] if op_type == 'extract_subs' else ['audio'],
+                'languages': split(data.get('languages')), 'codecs': split(data.get('codecs')),
+            })
+            return jsonify({'success': True, 'task_id': task_id, 'msg': 'Extraction queued. Please consult the log window.'})
 
         # === Core modification: Translation task ===
         elif op_type == 'translate_sub':
@@ -577,20 +2639,8 @@ def file_op():
             if not os.path.exists(full_target):
                 return jsonify({'success': False, 'msg': 'The file does not exist.'})
             
-            # Generate task ID
-            task_id = str(uuid.uuid4())[:8]
-            
-            # Initialise task status
-            task_store[task_id] = {
-                'status': 'running', 
-                'msg': 'Preparing to commence translation...', 
-                'logs': [], # Specifically designed for front-end log display
-                'type': 'translation'
-            }
-
-            # Launch background thread
-            t = threading.Thread(target=background_translate, args=(task_id, full_target))
-            t.start()
+            # Queue the job; the scheduler starts it when a network slot is free
+            task_id = scheduler.submit('translate', {'file_path': full_target, 'api_key': user_key or None})
             
             return jsonify({
                 'success': True, 
@@ -646,9 +2696,11 @@ def submit_task():
         save_default = request.form.get('save_default')
         is_private = request.form.get('private')
         comment = request.form.get('comment', '').strip()
-        piece_size = request.form.get('piece_size', '24')
+        piece_size = request.form.get('piece_size', 'auto')
         shot_mode = request.form.get('shot_mode', 'grid')
         shot_quality = request.form.get('shot_quality', 'medium')
+        shot_seek = request.form.get('shot_seek', SHOT_SEEK)
+        shot_sampling = request.form.get('shot_sampling', SHOT_SAMPLING)
 
         if save_default and tracker_url: save_default_tracker(tracker_url)
         full_source_path = get_safe_path(rel_path)
@@ -656,19 +2708,45 @@ def submit_task():
         if not os.path.exists(full_source_path):
             return jsonify({'success': False, 'msg': f"路径不存在: {full_source_path}"})
 
-        output_folder = os.path.join(full_source_path, "torrent") if os.path.isdir(full_source_path) else os.path.join(os.path.dirname(full_source_path), "torrent")
-        task_id = str(uuid.uuid4())[:8]
-        
-        t = threading.Thread(target=background_process, args=(
-            tracker_url, is_private, comment, piece_size, 
-            full_source_path, output_folder, task_id,
-            shot_mode, shot_quality
-        ))
-        t.start()
+        output_folder = default_output_folder(full_source_path)
+        task_id = scheduler.submit('seed', {
+            'tracker_url': tracker_url, 'is_private': is_private, 'comment': comment, 'piece_size': piece_size,
+            'full_source_path': full_source_path, 'output_folder': output_folder,
+            'shot_mode': shot_mode, 'shot_quality': shot_quality, 'shot_seek': shot_seek,
+            'shot_sampling': shot_sampling,
+        })
         return jsonify({'success': True, 'task_id': task_id})
     except Exception as e:
         return jsonify({'success': False, 'msg': str(e)})
 
+@app.route('/api/submit_batch', methods=['POST'])
+@login_required
+def submit_batch():
+    """Seed many folders/files in one job: `paths` (one per line) and/or `glob` patterns, relative to /data"""
+    try:
+        patterns = [unquote(p.strip()) for p in request.form.get('paths', '').splitlines() if p.strip()]
+        if request.form.get('glob', '').strip(): patterns.append(request.form['glob'].strip())
+        sources = []
+        for pattern in patterns:
+            matches = sorted(glob.glob(os.path.join(BASE_DIR, pattern.strip('/')))) if glob.has_magic(pattern) else [get_safe_path(pattern)]
+            for match in matches:
+                full = get_safe_path(os.path.relpath(match, BASE_DIR))
+                if os.path.basename(full.rstrip('/')) in ('torrent', '') or not os.path.exists(full): continue
+                if full not in sources: sources.append(full)
+        if not sources: return jsonify({'success': False, 'msg': 'No matching files or folders'})
+        if len(sources) > BATCH_MAX_ITEMS: return jsonify({'success': False, 'msg': f"Too many items ({len(sources)} > {BATCH_MAX_ITEMS})"})
+
+        tracker_url = request.form.get('tracker', '').strip()
+        if request.form.get('save_default') and tracker_url: save_default_tracker(tracker_url)
+        task_id = scheduler.submit('batch', {
+            'paths': sources, 'tracker_url': tracker_url, 'is_private': request.form.get('private'),
+            'comment': request.form.get('comment', '').strip(), 'piece_size': request.form.get('piece_size', 'auto'),
+            'shot_mode': request.form.get('shot_mode', 'grid'), 'shot_quality': request.form.get('shot_quality', 'medium'),
+            'shot_seek': request.form.get('shot_seek', SHOT_SEEK), 'shot_sampling': request.form.get('shot_sampling', SHOT_SAMPLING),
+        })
+        return jsonify({'success': True, 'task_id': task_id, 'items': len(sources)})
+    except Exception as e: return jsonify({'success': False, 'msg': str(e)})
+
 @app.route('/', methods=['GET'])
 @login_required
 def index():
@@ -676,11 +2754,14 @@ def index():
     task_id = request.args.get('task_id')
     
     download_link = None; mediainfo_link = None; shot_download_link = None; shot_preview_link = None  
-    mediainfo_content = ""; bbcode_content = ""; error_msg = None
+    mediainfo_content = ""; bbcode_content = ""; error_msg = None; batch_items = None
     
-    if task_id and task_id in task_store:
-        task_data = task_store[task_id]
-        if task_data['status'] == 'done':
+    task_data = task_store.view(task_id) if task_id else None
+    if task_data is not None:
+        if task_data['status'] == 'done' and 'items' in task_data:
+            batch_items = [dict(row, torrent_link=quote(row['files']['torrent']) if 'torrent' in row['files'] else None) for row in task_data['items']]
+            bbcode_content = task_data.get('bbcode', '')
+        elif task_data['status'] == 'done':
             if "Failure" in task_data['msg']: error_msg = task_data['msg']
             files = task_data.get('files', {})
             
@@ -708,28 +2789,28 @@ def index():
 
     return render_template('index.html', 
                            default_tracker=current_tracker,
+                           shot_seek=SHOT_SEEK,
+                           shot_sampling=SHOT_SAMPLING,
                            download_path=download_link,
                            mediainfo_link=mediainfo_link,
                            shot_download_link=shot_download_link,
                            shot_preview_link=shot_preview_link,
                            mediainfo_content=mediainfo_content,
                            bbcode_content=bbcode_content, 
+                           batch_items=batch_items,
                            error_msg=error_msg)
 
 @app.route('/download')
 @login_required
 def download_file():
     file_path = request.args.get('file')
-    if file_path:
-        # === Fix: Prioritise checking the original path; if it does not exist, attempt decoding. ===
-        # Handling scenario: The filename itself contains characters such as %20.
-        if os.path.exists(file_path): 
-            return send_file(file_path, as_attachment=True)
-            
-        decoded = unquote(file_path)
-        if os.path.exists(decoded): 
-            return send_file(decoded, as_attachment=True)
-            
+    # === Fix: Prioritise checking the original path; if it does not exist, attempt decoding. ===
+    # Handling scenario: The filename itself contains characters such as %20.
+    found = resolve_download_path(file_path)
+    if found: return send_artifact(found, as_attachment=True)
+    for candidate in ((file_path, unquote(file_path)) if file_path else ()):
+        shots = screenshot_files(candidate)
+        if shots: return send_screenshot_zip(candidate, shots)
     return "File not found"
 
 @app.route('/view_image')
@@ -739,15 +2820,11 @@ def view_image():
     if not file_path: return "No path provided", 400
     
     # === Fix: As above, prioritise checking the original path. ===
-    if os.path.exists(file_path): 
-        return send_file(file_path, mimetype='image/jpeg')
-
-    decoded_path = unquote_plus(file_path)
-    if os.path.exists(decoded_path): 
-        return send_file(decoded_path, mimetype='image/jpeg')
-        
+    found = resolve_download_path(file_path, unquote_plus)
+    if found: return send_artifact(found, mimetype='image/jpeg')
     return "Image not found", 404
 
 if __name__ == '__main__':
-    app.config['JSON_AS_ASCII'] = False
+    # Development server; production runs `gunicorn -c gunicorn.conf.py app:app` (see gunicorn.conf.py)
+    start_background_services()
     app.run(host='0.0.0.0', port=5000, threaded=True)
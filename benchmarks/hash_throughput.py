@@ -0,0 +1,86 @@
+"""
+SHA-1 piece hashing throughput on the local disk.
+
+Runs the torrent builder's own hash_pieces() over a test file for every
+combination of piece size and read-buffer size, dropping the file from the
+page cache between runs, and prints MB/s so HASH_READ_KB / HASH_WORKERS can
+be tuned for the storage behind /data.
+
+    python benchmarks/hash_throughput.py --dir /data --size-mb 2048
+    python benchmarks/hash_throughput.py --file /data/Movies/big.mkv --pieces 20,22,24
+"""
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from app import hash_pieces, HASH_WORKERS  # noqa: E402
+
+
+def drop_page_cache(path):
+    """Best effort: evict the file's clean pages so each run reads from disk"""
+    if not hasattr(os, 'posix_fadvise'): return
+    fd = os.open(path, os.O_RDONLY)
+    try: os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally: os.close(fd)
+
+
+def make_test_file(directory, size_mb):
+    fd, path = tempfile.mkstemp(prefix='.hashbench_', dir=directory)
+    block = os.urandom(4 * 1024 * 1024)
+    with os.fdopen(fd, 'wb') as f:
+        for _ in range(max(1, size_mb // 4)): f.write(block)
+        f.flush(); os.fsync(f.fileno())
+    return path
+
+
+def run(path, piece_exps, buffers_kb, workers):
+    size = os.path.getsize(path)
+    files = [(path, [os.path.basename(path)], size)]
+    results = []
+    for exp in piece_exps:
+        for buf_kb in buffers_kb:
+            drop_page_cache(path)
+            start = time.perf_counter()
+            hash_pieces(files, 1 << exp, workers=workers, read_size=buf_kb * 1024)
+            elapsed = time.perf_counter() - start
+            results.append({'piece_kib': (1 << exp) // 1024, 'read_kb': buf_kb or 'piece',
+                            'workers': workers, 'seconds': round(elapsed, 3),
+                            'mb_per_s': round(size / elapsed / 1048576, 1)})
+            r = results[-1]
+            read = 'whole piece' if r['read_kb'] == 'piece' else f"{r['read_kb']} KB"
+            print(f"piece {r['piece_kib']:>6} KiB  read {read:>11}  "
+                  f"{r['seconds']:>8.2f} s  {r['mb_per_s']:>8.1f} MB/s", flush=True)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', default='.', help='directory on the storage to test (a temp file is created there)')
+    parser.add_argument('--file', help='hash an existing file instead of creating one')
+    parser.add_argument('--size-mb', type=int, default=1024, help='size of the generated test file')
+    parser.add_argument('--pieces', default='18,20,22,24', help='piece size exponents (15-28)')
+    parser.add_argument('--buffers', default='0,256,1024,4096', help='read sizes in KB, 0 = whole piece')
+    parser.add_argument('--workers', type=int, default=HASH_WORKERS)
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    path = args.file or make_test_file(args.dir, args.size_mb)
+    try:
+        results = run(path, [int(x) for x in args.pieces.split(',')],
+                      [int(x) for x in args.buffers.split(',')], args.workers)
+    finally:
+        if not args.file: os.remove(path)
+
+    best = max(results, key=lambda r: r['mb_per_s'])
+    print(f"\nFastest: piece {best['piece_kib']} KiB, read {best['read_kb']} (KB) -> {best['mb_per_s']} MB/s")
+    if best['read_kb'] != 'piece': print(f"Suggested: HASH_READ_KB={best['read_kb']}")
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""
+HTTP throughput and latency against a running server (dev server or gunicorn).
+
+Logs in once, then keeps --concurrency clients busy for --seconds on a mix of the
+endpoints the UI hits most: status polling, directory listing and a file download.
+Reports requests/s and latency percentiles per endpoint.
+
+    gunicorn -c gunicorn.conf.py app:app &
+    python benchmarks/http_load.py --url http://127.0.0.1:5000 --path Movies --download Movies/x.nfo
+    python benchmarks/http_load.py --concurrency 64 --seconds 30 --json runs/gthread-2x16.json
+"""
+import argparse
+import itertools
+import json
+import os
+import sys
+import threading
+import time
+
+import requests
+
+
+def percentile(values, pct):
+    if not values: return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+def make_requests(args):
+    """(name, callable(session)) pairs; clients cycle through them"""
+    base = args.url.rstrip('/')
+    mix = [
+        ('status', lambda s: s.get(f"{base}/api/status", params={'task_id': 'bench-missing'})),
+        ('queue', lambda s: s.get(f"{base}/api/queue")),
+        ('list_files', lambda s: s.post(f"{base}/api/list_files", json={'path': args.path})),
+    ]
+    if args.download: mix.append(('download', lambda s: s.get(f"{base}/download", params={'file': args.download})))
+    return mix
+
+
+def client(args, mix, deadline, results, lock):
+    session = requests.Session()
+    session.post(f"{args.url.rstrip('/')}/login", data={'username': args.user, 'password': args.password})
+    local = {name: ([], 0) for name, _ in mix}
+    for name, call in itertools.cycle(mix):
+        if time.time() >= deadline: break
+        started = time.perf_counter()
+        try:
+            ok = call(session).status_code < 400
+        except requests.RequestException:
+            ok = False
+        latencies, errors = local[name]
+        latencies.append(time.perf_counter() - started)
+        local[name] = (latencies, errors + (not ok))
+    with lock:
+        for name, (latencies, errors) in local.items():
+            results[name][0].extend(latencies)
+            results[name][1] += errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', default='http://127.0.0.1:5000')
+    parser.add_argument('--user', default=os.environ.get('ADMIN_USER', 'admin'))
+    parser.add_argument('--password', default=os.environ.get('ADMIN_PASS', 'password123'))
+    parser.add_argument('--path', default='', help='directory (relative to BASE_DIR) to list')
+    parser.add_argument('--download', help='file (absolute or relative to BASE_DIR) to download')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--json', help='write the results to this file')
+    args = parser.parse_args()
+
+    mix = make_requests(args)
+    results = {name: [[], 0] for name, _ in mix}
+    lock = threading.Lock()
+    deadline = time.time() + args.seconds
+    threads = [threading.Thread(target=client, args=(args, mix, deadline, results, lock)) for _ in range(args.concurrency)]
+    started = time.time()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time.time() - started
+
+    rows = []
+    print(f"{'endpoint':<12} {'req/s':>9} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'errors':>7}")
+    for name, (latencies, errors) in results.items():
+        row = {'endpoint': name, 'requests': len(latencies), 'rps': round(len(latencies) / elapsed, 1), 'errors': errors,
+               **{f"p{p}_ms": round(percentile(latencies, p) * 1000, 1) for p in (50, 95, 99)}}
+        rows.append(row)
+        print(f"{name:<12} {row['rps']:>9.1f} {row['p50_ms']:>8.1f} {row['p95_ms']:>8.1f} {row['p99_ms']:>8.1f} {errors:>7}")
+    total = sum(r['requests'] for r in rows)
+    print(f"{'total':<12} {total / elapsed:>9.1f}")
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'params': vars(args), 'seconds': round(elapsed, 2), 'endpoints': rows}, f, indent=2)
+    if any(r['errors'] for r in rows): sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,313 @@
+"""
+End-to-end benchmark of the seeding and translation pipelines.
+
+Synthesizes its own inputs in a scratch BASE_DIR (ffmpeg lavfi test media in
+several durations/containers, a large sparse file, a deep tree of small files
+and SRTs of configurable length), starts local mock DeepSeek and Pixhost
+servers with configurable latency, then runs each stage through the app's own
+functions and reports wall time, subprocess launches, peak RSS and throughput.
+
+    python benchmarks/pipeline.py --json runs/today.json
+    python benchmarks/pipeline.py --api-latency 0.3 --cues 2000 --compare runs/yesterday.json
+
+Stages whose tools are missing (ffmpeg/ffprobe/mediainfo) are reported as
+skipped. Inputs are deterministic, so two runs on the same machine compare.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+# === Mock servers ===
+class MockHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, *args): pass
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def _send(self, status, content_type, payload):
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        body = self._body()
+        time.sleep(self.latency)
+        if self.path.endswith('/chat/completions'): self._chat(json.loads(body))
+        elif self.path.endswith('/images'):
+            name = f"{random.getrandbits(32):08x}.jpg"
+            self._send(200, 'application/json', json.dumps({'th_url': f"https://t0.pixhost.to/thumbs/0/{name}"}).encode())
+        else: self._send(404, 'text/plain', b'not found')
+
+    def _chat(self, request):
+        """Stream the request's SRT back with every text line 'translated', like DeepSeek would"""
+        source = request['messages'][-1]['content'].split('\n\n', 1)[-1]
+        out = []
+        for line in source.split('\n'):
+            is_meta = not line.strip() or line.strip().isdigit() or '-->' in line
+            out.append(line if is_meta else f"译 {line}")
+        text = "\n".join(out)
+        events = []
+        for i in range(0, len(text), 200):
+            events.append({'id': 'bench', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'deepseek-chat',
+                           'choices': [{'index': 0, 'delta': {'content': text[i:i + 200]}, 'finish_reason': None}]})
+        tokens = len(source) // 4
+        events.append({'id': 'bench', 'object': 'chat.completion.chunk', 'created': 0, 'model': 'deepseek-chat', 'choices': [],
+                       'usage': {'prompt_tokens': tokens, 'completion_tokens': tokens, 'total_tokens': 2 * tokens}})
+        payload = "".join(f"data: {json.dumps(e, ensure_ascii=False)}\n\n" for e in events) + "data: [DONE]\n\n"
+        self._send(200, 'text/event-stream', payload.encode('utf-8'))
+
+
+def start_mock_server(latency):
+    handler = type('Handler', (MockHandler,), {'latency': latency})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+# === Synthetic inputs ===
+MEDIA = [  # (name, duration seconds, lavfi source, container-specific args)
+    ('short.mp4', 90, 'testsrc2=size=1280x720:rate=24', ['-c:v', 'libx264', '-preset', 'ultrafast', '-g', '48']),
+    ('long.mkv', 1500, 'testsrc2=size=640x360:rate=24', ['-c:v', 'libx264', '-preset', 'ultrafast', '-g', '240']),
+]
+SHOT_VARIANTS = (('grid', 'accurate'), ('full', 'accurate'), ('grid', 'keyframe'), ('full', 'keyframe')) # (mode, seek)
+
+
+def make_media(directory, ffmpeg):
+    """Encode the test clips once; with --dir they are reused by later runs"""
+    made = []
+    for name, duration, source, codec_args in MEDIA:
+        path = os.path.join(directory, name)
+        if os.path.exists(path):
+            made.append(path)
+            continue
+        cmd = [ffmpeg, '-v', 'error', '-y', '-f', 'lavfi', '-i', source, '-f', 'lavfi', '-i', 'sine=f=440',
+               '-t', str(duration), *codec_args, '-c:a', 'aac', path]
+        if subprocess.run(cmd).returncode == 0: made.append(path)
+    return made
+
+
+def make_sparse(path, size_gb):
+    with open(path, 'wb') as f: f.truncate(int(size_gb * (1 << 30)))
+    return path
+
+
+def make_tree(root, dirs, files_per_dir):
+    """A season-like tree of small files for the largest-file scan"""
+    for d in range(dirs):
+        sub = os.path.join(root, f"Disc{d:02d}", "EXTRAS")
+        os.makedirs(sub, exist_ok=True)
+        for i in range(files_per_dir):
+            with open(os.path.join(sub, f"clip{i:03d}.m2ts"), 'wb') as f: f.truncate(1024 * (i + 1))
+
+
+def make_srt(path, cues, seed=7):
+    rng = random.Random(seed)
+    words = "the of and to a in that is was he for it with as his on be at by had".split()
+    with open(path, 'w', encoding='utf-8') as f:
+        for i in range(cues):
+            start = i * 3
+            ts = lambda s: f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d},000"
+            line = " ".join(rng.choice(words) for _ in range(rng.randint(4, 12))).capitalize() + "."
+            f.write(f"{i + 1}\n{ts(start)} --> {ts(start + 2)}\n{line}\n\n")
+    return path
+
+
+# === Measurement ===
+def subprocess_launches(app):
+    return sum(v for (name, _), v in app.metrics.counters.items() if name == 'torrentmaker_subprocess_launches_total')
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    scale = 1 if sys.platform == 'darwin' else 1024
+    return round(resource.getrusage(who).ru_maxrss * scale / 1048576, 1)
+
+
+def measure(app, results, name, fn, amount=None, unit=None):
+    launches = subprocess_launches(app)
+    started = time.perf_counter()
+    try:
+        value = fn()
+        error = None
+    except Exception as e:
+        value, error = None, str(e)
+    elapsed = time.perf_counter() - started
+    if callable(amount): amount = amount(value)
+    row = {'stage': name, 'seconds': round(elapsed, 3), 'subprocesses': subprocess_launches(app) - launches,
+           'peak_rss_mb': peak_rss_mb(resource.RUSAGE_SELF), 'child_peak_rss_mb': peak_rss_mb(resource.RUSAGE_CHILDREN)}
+    if amount is not None and elapsed > 0: row.update(throughput=round(amount / elapsed, 2), unit=unit)
+    if error: row['error'] = error
+    results.append(row)
+    extra = f"  {row['throughput']:>10.2f} {unit}" if 'throughput' in row else ""
+    print(f"{name:<34} {row['seconds']:>8.2f} s  {row['subprocesses']:>4} procs  "
+          f"rss {row['peak_rss_mb']:>7.1f} MB{extra}{'  ERROR ' + error if error else ''}", flush=True)
+    return value
+
+
+def skip(results, name, reason):
+    results.append({'stage': name, 'skipped': reason})
+    print(f"{name:<34} skipped ({reason})", flush=True)
+
+
+MARKER = '.torrentmaker-bench' # Marks a directory as the benchmark's own, so a later run may clear it
+
+
+def reset_scratch(base_dir, keep):
+    """
+    Start every run cold: drop caches, databases and outputs of earlier runs, keep only the
+    synthesized media. Refuses a non-empty directory that was not created by this benchmark.
+    """
+    names = os.listdir(base_dir)
+    if names and MARKER not in names:
+        sys.exit(f"{base_dir} is not empty and was not created by this benchmark; pass an empty or new --dir")
+    open(os.path.join(base_dir, MARKER), 'a').close()
+    for name in names:
+        if name in (keep, MARKER): continue
+        path = os.path.join(base_dir, name)
+        if os.path.isdir(path) and not os.path.islink(path): shutil.rmtree(path)
+        else: os.remove(path)
+
+
+def run(args, base_dir):
+    reset_scratch(base_dir, keep='Bench.Show.S01')
+    server = start_mock_server(args.api_latency)
+    url = f"http://127.0.0.1:{server.server_address[1]}"
+    # The app reads these at import time
+    os.environ.update({'BASE_DIR': base_dir, 'DEEPSEEK_BASE_URL': url, 'DEEPSEEK_API_KEY': 'bench',
+                       'PIXHOST_UPLOAD_URL': f"{url}/images"})
+    import app
+
+    ffmpeg, ffprobe, mediainfo = shutil.which('ffmpeg'), shutil.which('ffprobe'), shutil.which('mediainfo')
+    media_dir = os.path.join(base_dir, 'Bench.Show.S01')
+    os.makedirs(media_dir, exist_ok=True)
+    results = []
+
+    media = measure(app, results, 'setup_media', lambda: make_media(media_dir, ffmpeg)) if ffmpeg else []
+    if not ffmpeg: skip(results, 'setup_media', 'ffmpeg not found')
+    results[-1]['setup'] = True
+    make_sparse(os.path.join(media_dir, 'Bench.Show.S01E01.remux.mkv'), args.sparse_gb)
+    make_tree(media_dir, args.tree_dirs, args.tree_files)
+
+    files = app.scan_torrent_files(media_dir)
+    payload = sum(size for _, _, size in files)
+    torrent = os.path.join(base_dir, 'bench.torrent')
+    measure(app, results, 'torrent_hash', lambda: app.build_torrent(media_dir, torrent, 'http://tracker/announce', app.auto_piece_exponent(payload)),
+            amount=payload / 1048576, unit='MB/s')
+    measure(app, results, 'torrent_cached', lambda: app.build_torrent(media_dir, torrent, 'http://tracker/announce', app.auto_piece_exponent(payload)),
+            amount=payload / 1048576, unit='MB/s')
+    measure(app, results, 'find_largest_file', lambda: app.find_largest_file(media_dir),
+            amount=args.tree_dirs * args.tree_files, unit='files/s')
+
+    images = []
+    for name, *_ in MEDIA:
+        path, tag = os.path.join(media_dir, name), os.path.splitext(name)[0]
+        # The same stage names whether or not the tools are here, so --compare lines up runs from any machine
+        shots = [(f'screenshots_{mode}_{seek}[{tag}]', mode, seek) for mode, seek in SHOT_VARIANTS]
+        if not ffprobe or path not in media:
+            reason = 'ffprobe not found' if not ffprobe else 'clip not encoded (ffmpeg missing or failed)'
+            for stage in [f'probe[{tag}]', f'mediainfo[{tag}]'] + [stage for stage, _, _ in shots]: skip(results, stage, reason)
+            continue
+        measure(app, results, f'probe[{tag}]', lambda path=path: app.probe_media(path))
+        if mediainfo: measure(app, results, f'mediainfo[{tag}]', lambda path=path: app.get_mediainfo_text(path))
+        else: skip(results, f'mediainfo[{tag}]', 'mediainfo not found')
+        for stage, mode, seek in shots:
+            base = os.path.join(base_dir, f"{tag}_{mode}_{seek}")
+            res = measure(app, results, stage,
+                          lambda path=path, base=base, mode=mode, seek=seek: app.generate_screenshots(path, base, mode, 'medium', seek=seek),
+                          amount=lambda r: len(r[1].get('images', [])) if r and isinstance(r[1], dict) else 0, unit='images/s')
+            if res and isinstance(res[1], dict): images.extend(res[1].get('images', []))
+
+    if not images: # Uploads only need files to send
+        for i in range(6):
+            p = os.path.join(base_dir, f"upload_{i}.jpg")
+            with open(p, 'wb') as f: f.write(os.urandom(200 * 1024))
+            images.append(p)
+    app.task_store['bench-upload'] = {'status': 'running'}
+    measure(app, results, 'pixhost_upload', lambda: app.upload_images('bench-upload', images), amount=len(images), unit='images/s')
+
+    srt = make_srt(os.path.join(base_dir, 'bench.en.srt'), args.cues)
+    app.task_store['bench-translate'] = {'status': 'running'}
+    measure(app, results, 'translate_srt', lambda: app.background_translate('bench-translate', srt), amount=args.cues, unit='cues/s')
+    if app.task_store['bench-translate'].get('status') != 'done': results[-1]['error'] = 'translation did not finish'
+    os.remove(os.path.join(base_dir, 'bench.en.chi.srt')) # Same input again: served from translation memory
+    app.task_store['bench-translate-tm'] = {'status': 'running'}
+    measure(app, results, 'translate_srt_memory', lambda: app.background_translate('bench-translate-tm', srt), amount=args.cues, unit='cues/s')
+
+    server.shutdown()
+    versions = {'python': platform.python_version(), 'platform': platform.platform()}
+    if ffmpeg: versions['ffmpeg'] = subprocess.run([ffmpeg, '-version'], capture_output=True, text=True).stdout.split('\n')[0]
+    return {'meta': {'params': vars(args), 'versions': versions, 'started': time.strftime('%Y-%m-%dT%H:%M:%S')},
+            'stages': results}
+
+
+def compare(current, baseline_path, threshold):
+    """
+    Print per-stage deltas against a previous run; returns the stages that got slower than the
+    threshold. Stages skipped or missing on either side are listed as such, never counted as slower.
+    """
+    with open(baseline_path) as f: baseline = {s['stage']: s for s in json.load(f)['stages'] if not s.get('setup')}
+    slower = []
+    cell = lambda r: f"{r['seconds']:>8.2f}s" if r and 'seconds' in r else f"{'skipped' if r else 'missing':>9}"
+    print(f"\n{'stage':<34} {'before':>9} {'after':>9} {'change':>8}")
+    for row in current['stages']:
+        if row.get('setup'): continue
+        before = baseline.pop(row['stage'], None)
+        if 'seconds' not in row or not before or 'seconds' not in before:
+            print(f"{row['stage']:<34} {cell(before)} {cell(row)}")
+            continue
+        change = (row['seconds'] - before['seconds']) / before['seconds'] * 100 if before['seconds'] else 0.0
+        flag = '  <-- slower' if change > threshold else ''
+        print(f"{row['stage']:<34} {before['seconds']:>8.2f}s {row['seconds']:>8.2f}s {change:>+7.1f}%{flag}")
+        if flag: slower.append(row['stage'])
+    for name, before in baseline.items(): print(f"{name:<34} {cell(before)} {cell(None)}")
+    return slower
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--dir', help='scratch directory, new or empty; kept between runs to reuse the test media '
+                                      '(default: a temp dir, removed afterwards)')
+    parser.add_argument('--sparse-gb', type=float, default=2.0, help='size of the sparse "remux" file')
+    parser.add_argument('--tree-dirs', type=int, default=20)
+    parser.add_argument('--tree-files', type=int, default=100, help='small files per tree directory')
+    parser.add_argument('--cues', type=int, default=1000, help='cues in the synthetic SRT')
+    parser.add_argument('--api-latency', type=float, default=0.2, help='seconds the mock DeepSeek/Pixhost wait per request')
+    parser.add_argument('--json', help='write the results to this file')
+    parser.add_argument('--compare', help='previous --json output to diff against')
+    parser.add_argument('--threshold', type=float, default=10.0, help='percent slowdown that fails --compare')
+    args = parser.parse_args()
+
+    random.seed(1)
+    base_dir = args.dir or tempfile.mkdtemp(prefix='tm_bench_')
+    os.makedirs(base_dir, exist_ok=True)
+    try: report = run(args, base_dir)
+    finally:
+        if not args.dir: shutil.rmtree(base_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as f: json.dump(report, f, indent=2, ensure_ascii=False)
+    if args.compare and compare(report, args.compare, args.threshold): sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,26 @@
+"""
+Production server settings: `gunicorn -c gunicorn.conf.py app:app`
+
+gthread workers: each process serves requests from a thread pool, so long downloads and
+event streams hold one thread rather than a whole worker. Task state lives in SQLite under
+BASE_DIR and is shared by every worker; one of them (the holder of BASE_DIR/.leader.lock)
+runs the job queue and the media index. See "Serving" in the README for sizing.
+"""
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+worker_class = 'gthread'
+workers = int(os.environ.get('WEB_WORKERS', 2))
+threads = int(os.environ.get('WEB_THREADS', 16)) # Concurrent requests per worker, open event streams included
+# gthread workers heartbeat from their main loop, so this only catches a wedged process, not slow requests
+timeout = 120
+graceful_timeout = 30
+keepalive = 5
+accesslog = '-'
+errorlog = '-'
+
+
+def post_worker_init(worker):
+    # Not preload_app: threads and SQLite handles must be created after the fork, in each worker
+    from app import start_background_services
+    start_background_services()